@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Measures messages per second through each available wire codec for the
+# message shapes that dominate the workloads.
+#
+#   python bench/bench_codec.py
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from node import CODECS
+
+
+def messages():
+    broadcast = {'src': 'n1', 'dest': 'n2', 'body': {'type': 'broadcast', 'message': 1234, 'msg_id': 42}}
+    entries = [{'term': 3, 'op': {'src': 'c4', 'dest': 'n1', 'body': {'type': 'write', 'key': i, 'value': i * 7, 'msg_id': i}}} for i in range(100)]
+    append_entries = {'src': 'n1', 'dest': 'n2', 'body': {
+        'type': 'append_entries', 'term': 3, 'leader_id': 'n1', 'entries': entries,
+        'leader_commit': 900, 'prev_log_index': 899, 'prev_log_term': 3, 'msg_id': 43}}
+    replicate = {'src': 'n1', 'dest': 'n2', 'body': {'type': 'replicate', 'value': list(range(10000))}}
+    return [('broadcast', broadcast, 200000), ('append_entries x100', append_entries, 5000), ('g-set replicate 10k', replicate, 500)]
+
+
+def bench(codec, message, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        data = codec.encode(message)
+    encode = iterations / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.decode(data)
+    decode = iterations / (time.perf_counter() - start)
+    return encode, decode
+
+
+def main():
+    codecs = []
+    for name, cls in CODECS.items():
+        try:
+            codecs.append(cls())
+        except ImportError:
+            print(f'{name}: not installed')
+
+    for label, message, iterations in messages():
+        baseline = None
+        for codec in codecs:
+            encode, decode = bench(codec, message, iterations)
+            baseline = baseline or (encode, decode)
+            print(f'{label:22} {codec.name:8} encode {encode:12,.0f} msg/s ({encode / baseline[0]:4.1f}x)'
+                  f'  decode {decode:12,.0f} msg/s ({decode / baseline[1]:4.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Measures how long making a batch of Raft entries durable takes, with
+# persistence off (entries only encoded, as Log does in memory), on without
+# fsync, on with one fsync per entry, and on with one fsync per batch as
+# the group commit in raft.py does. Uses the storage modules directly since
+# raft.py runs a node on import.
+#
+#   python bench/bench_raft_commit.py [directory]
+
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from hard_state import HardState
+from node import default_codec
+from segment_log import SegmentLog
+
+COMMITS = 200
+
+
+def entries(term, start, count):
+    return [{'term': term, 'op': {'src': 'c4', 'dest': 'n1', 'body': {'type': 'write', 'key': i % 100, 'value': i * 7, 'msg_id': i}}}
+            for i in range(start, start + count)]
+
+
+def commit(codec, log, state, mode, batch, term):
+    encoded = [codec.encode(e) for e in batch]
+    if mode == 'off':
+        return
+    state.record(term, 'n1')
+    if mode == 'fsync per entry':
+        for entry, payload in zip(batch, encoded):
+            log.append([entry], [payload])
+            log.sync()
+        state.sync()
+    else:
+        log.append(batch, encoded)
+        if mode == 'group commit':
+            log.sync()
+            state.sync()
+
+
+def bench(directory, codec, mode, batch_size):
+    path = tempfile.mkdtemp(dir=directory)
+    log = SegmentLog(path, codec, fsync = False)
+    state = HardState(path, codec)
+    log.recover()
+    state.recover()
+    latencies = []
+    for i in range(COMMITS):
+        batch = entries(1, i * batch_size, batch_size)
+        start = time.perf_counter()
+        commit(codec, log, state, mode, batch, 1)
+        latencies.append(time.perf_counter() - start)
+    shutil.rmtree(path)
+    total = sum(latencies)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99)], COMMITS * batch_size / total
+
+
+def main():
+    directory = sys.argv[1] if 1 < len(sys.argv) else None
+    codec = default_codec()
+    for batch_size in (1, 16, 64):
+        for mode in ('off', 'no fsync', 'fsync per entry', 'group commit'):
+            median, p99, rate = bench(directory, codec, mode, batch_size)
+            print(f'batch {batch_size:3} {mode:16} median {median * 1000:8.3f}ms  p99 {p99 * 1000:8.3f}ms  {rate:12,.0f} entries/s')
+
+
+if __name__ == '__main__':
+    main()
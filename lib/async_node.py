@@ -0,0 +1,110 @@
+import asyncio
+import sys
+import threading
+from errors import RPCError
+from node import Node
+
+
+# A Node that runs on an asyncio event loop. Handlers registered as coroutine
+# functions run as tasks on the loop and can `await self.rpc(response)` without
+# parking a thread per outstanding request. Thread-style handlers written for
+# Node keep working unchanged: they run on the node's worker pool and can still
+# use send, rpc with a callback, and sync_rpc.
+class AsyncNode(Node):
+
+    def __init__(self, workers = 16, reply_workers = 4, max_queue = 4096):
+        super().__init__(workers, reply_workers, max_queue)
+        self.loop = None
+        self.loop_thread = None
+        self.transport = None
+        self.tasks = set()
+
+    def send(self, response):
+        self.debug('Sending response: %s', response, category='send')
+        data = self.codec.encode(response)
+        if threading.get_ident() == self.loop_thread:
+            self.transport.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.transport.write, data)
+        return len(data)
+
+    # With a handler this behaves like Node.rpc. Without one it returns a
+    # future that resolves to the reply, or fails with RPCError.timeout; it
+    # must then be called on the loop. Cancelling the future drops the
+    # callback.
+    def rpc(self, response, handler = None, timeout = None):
+        if handler is not None:
+            return super().rpc(response, handler, timeout)
+        future = self.loop.create_future()
+        msg_id = self.register_callback(response, future, timeout)
+        future.add_done_callback(lambda f: self.callbacks.pop(msg_id, None) if f.cancelled() else None)
+        self.send(response)
+        return future
+
+    def expire_callback(self, msg_id, callback):
+        if not isinstance(callback, asyncio.Future):
+            return super().expire_callback(msg_id, callback)
+
+        def expire():
+            if not callback.done():
+                callback.set_exception(RPCError.timeout(f'RPC {msg_id} timed out'))
+        self.loop.call_soon_threadsafe(expire)
+
+    def dispatch(self, request):
+        body = request['body']
+        if body.get('in_reply_to'):
+            callback = self.callbacks.pop(body['in_reply_to'], None)
+            if isinstance(callback, asyncio.Future):
+                if not callback.done():
+                    callback.set_result(request)
+            elif callback:
+                self.reply_dispatcher.submit(self.execute_callback, callback.resolve, request)
+            return
+
+        handler = self.handlers.get(body['type'])
+        if asyncio.iscoroutinefunction(handler):
+            task = self.loop.create_task(self.run_handler(handler, request))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        else:
+            super().dispatch(request)
+
+    def execute_callback(self, callback, request):
+        try:
+            callback(request)
+        except(RPCError, Exception) as e:
+            self.error('got exception %r', e)
+
+    async def run_handler(self, handler, request):
+        try:
+            await handler(request)
+        except(RPCError, Exception) as e:
+            self.error('got exception %r', e)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        reader = asyncio.StreamReader(limit = 2 ** 24)
+        await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        self.transport, _ = await self.loop.connect_write_pipe(asyncio.Protocol, sys.stdout)
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            request = self.parse_message(line)
+            self.debug('Received message: %s', request, category='recv')
+            self.dispatch(request)
+
+        # stdin closed; let in-flight handlers finish, then flush stdout
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions = True)
+        await self.loop.run_in_executor(None, self.dispatcher.drain)
+        await asyncio.sleep(0)
+        self.transport.close()
+        self.writer.drain()
+
+    def main(self):
+        asyncio.run(self.run())
@@ -1,15 +1,148 @@
 #!/usr/bin/env python
 
-from node import Node
+import os
+import itertools
+import statistics
+import topology
+from int_set import IntSet
+from node import create_node
 
 class Broadcast():
-    def __init__(self):
-        self.node = Node()
+    SYNC_INTERVAL = 1 # seconds between anti-entropy syncs with the next peer
+    REPORT_INTERVAL = 5
+
+    # batch_interval > 0 buffers new messages per neighbor and gossips them
+    # as one broadcast_batch rpc per neighbor every batch_interval seconds.
+    # 0 keeps the one rpc per message per neighbor protocol. Defaults to
+    # BROADCAST_BATCH_INTERVAL from the environment.
+    #
+    # overlay ('tree', 'kary' or 'hub', see topology.py) replaces the provided
+    # topology with one computed from node_ids; the provided edges are then
+    # only used by anti-entropy. Defaults to BROADCAST_OVERLAY, with
+    # BROADCAST_FANOUT as k for 'kary'.
+    #
+    # Gossip is sent once and never retried. Every sync_interval seconds
+    # (BROADCAST_SYNC_INTERVAL) the node sends a digest of its messages to
+    # one peer, round robin over gossip and repair edges, and the peer sends
+    # back whatever it has that the digest lacks; those are then gossiped
+    # on like any new message.
+    def __init__(self, batch_interval = None, overlay = None, fanout = None, sync_interval = None):
+        self.node = create_node()
         self.neighbors = []
-        self.messages = set()
-        self.node.handlers['topology'] = lambda request: self.node.handle_topology(request, self)
-        self.node.handlers['broadcast'] = lambda request: self.node.handle_broadcast(request, self)
+        self.repair_neighbors = []
+        self.messages = IntSet()
+        if batch_interval is None:
+            batch_interval = float(os.environ.get('BROADCAST_BATCH_INTERVAL', 0))
+        self.batch_interval = batch_interval
+        self.overlay = overlay or os.environ.get('BROADCAST_OVERLAY')
+        self.fanout = fanout or int(os.environ.get('BROADCAST_FANOUT', 4))
+        self.node.handlers['topology'] = self.handle_topology
         self.node.handlers['read'] = lambda request: self.node.handle_read(request, self)
-        
+        self.node.handlers['sync'] = self.handle_sync
+        self.node.handlers['sync_ok'] = lambda request: self.receive(request['body']['messages'], request['src'])
+        self.sync_peers = None
+        if sync_interval is None:
+            sync_interval = float(os.environ.get('BROADCAST_SYNC_INTERVAL', Broadcast.SYNC_INTERVAL))
+        self.node.every(self.sync, sync_interval)
+
+        if batch_interval:
+            self.pending = dict() # neighbor -> {message: queued at}
+            self.ops = 0 # broadcasts received from clients
+            self.rpcs = 0 # broadcast_batch rpcs sent
+            self.latencies = [] # queued -> acked, per message and neighbor
+            self.node.handlers['broadcast'] = self.handle_broadcast
+            self.node.handlers['broadcast_batch'] = self.handle_broadcast_batch
+            self.node.every(self.flush, batch_interval)
+            self.node.every(self.report, Broadcast.REPORT_INTERVAL)
+        else:
+            self.node.handlers['broadcast'] = lambda request: self.node.handle_broadcast(request, self)
+
+    def handle_topology(self, request):
+        if not self.overlay:
+            self.node.handle_topology(request, self)
+            with self.node.lock:
+                self.sync_peers = itertools.cycle(self.neighbors) if self.neighbors else None
+            return
+
+        provided = request['body']['topology']
+        with self.node.lock:
+            self.neighbors, self.repair_neighbors = topology.overlay(
+                self.overlay, self.node.node_id, self.node.node_ids, provided, self.fanout)
+            peers = self.neighbors + self.repair_neighbors
+            self.sync_peers = itertools.cycle(peers) if peers else None
+        self.node.log(f'My {self.overlay} neighbors are {self.neighbors}, repair neighbors {self.repair_neighbors}')
+        self.node.reply(self.node.generate_response('topology_ok', request['src']), request)
+
+    def handle_broadcast(self, request):
+        self.node.reply(self.node.generate_response('broadcast_ok', request['src']), request)
+        with self.node.lock:
+            self.ops += 1
+        self.receive([request['body']['message']], request['src'])
+
+    def handle_broadcast_batch(self, request):
+        self.node.reply(self.node.generate_response('broadcast_batch_ok', request['src']), request)
+        self.receive(request['body']['messages'], request['src'])
+
+    # Stores messages and passes the new ones on to every neighbor except
+    # the one we got them from: queued for the next batch in batched mode,
+    # gossiped one by one otherwise
+    def receive(self, messages, src):
+        with self.node.lock:
+            new_messages = [m for m in messages if self.messages.add(m)]
+            if not new_messages:
+                return
+            if not self.batch_interval:
+                for n in self.neighbors:
+                    if n != src:
+                        for m in new_messages:
+                            self.node.gossip(n, m)
+                return
+            now = self.node.now()
+            for n in self.neighbors:
+                if n != src:
+                    pending = self.pending.setdefault(n, dict())
+                    for m in new_messages:
+                        pending.setdefault(m, now)
+
+    def flush(self):
+        with self.node.lock:
+            for n, batch in self.pending.items():
+                if not batch:
+                    continue
+                self.pending[n] = dict()
+                self.rpcs += 1
+                response = self.node.generate_response('broadcast_batch', n, {'messages': list(batch)})
+                self.node.rpc(response, lambda resp, batch=batch: self.acked(batch))
+
+    # The neighbor acks a batch as a whole
+    def acked(self, batch):
+        now = self.node.now()
+        with self.node.lock:
+            self.latencies.extend(now - queued for queued in batch.values())
+
+    def sync(self):
+        with self.node.lock:
+            if not self.sync_peers:
+                return
+            peer = next(self.sync_peers)
+            ranges = self.messages.ranges()
+        self.node.send(self.node.generate_response('sync', peer, {'ranges': ranges}))
+
+    # Sends back the messages the sender's digest does not cover, if any
+    def handle_sync(self, request):
+        ranges = IntSet.from_ranges(request['body']['ranges'])
+        with self.node.lock:
+            missing = self.messages.difference(ranges)
+        if missing:
+            self.node.send(self.node.generate_response('sync_ok', request['src'], {'messages': missing}))
+
+    def report(self):
+        with self.node.lock:
+            latencies, self.latencies = self.latencies, []
+            msgs_per_op = self.rpcs / self.ops if self.ops else 0
+        if latencies:
+            self.node.log(f'broadcast_batch: {msgs_per_op:.2f} rpcs/op, median hop latency {statistics.median(latencies) * 1000:.1f}ms, '
+                          f'max {max(latencies) * 1000:.1f}ms over {len(latencies)} acks')
+
 
 Broadcast().node.main()
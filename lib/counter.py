@@ -1,21 +1,25 @@
 #!/usr/bin/env python
 
 import threading
-from node import Node
+from node import create_node
 
 
+# add mutates in place; callers serialise access with their own lock.
+# merge still returns a new Counter. The sum of all entries is kept up to
+# date on every change so read is O(1).
 class Counter():
-    def __init__(self, counters = dict()):
-        self.counters = counters
+    def __init__(self, counters = None):
+        self.counters = counters if counters is not None else dict()
+        self.total = sum(self.counters.values())
 
     def from_json(self, json):
         return Counter(json)
 
     def to_json(self):
-        return self.counters
+        return dict(self.counters)
 
     def read(self):
-        return sum(self.counters.values())
+        return self.total
 
     def _none_or_max(self, a, b):        
         if  a is None:
@@ -30,14 +34,28 @@ class Counter():
         return Counter({k: self._none_or_max(self.counters.get(k), other.counters.get(k)) for k in all_keys})
 
     def add(self, node_id, delta):
-        local = self.counters.copy()
-        local[node_id] = local[node_id] + delta if local.get(node_id) else delta
-        return Counter(local)
+        self.counters[node_id] = self.counters.get(node_id, 0) + delta
+        self.total += delta
+        return self
+
+    # Merges a {node_id: value} map in place; returns True if anything changed
+    def merge_entries(self, entries):
+        changed = False
+        for k, v in entries.items():
+            if k not in self.counters or self.counters[k] < v:
+                self.total += v - self.counters.get(k, 0)
+                self.counters[k] = v
+                changed = True
+        return changed
+
+    # Entries whose value is ahead of the given {node_id: value} map
+    def entries_after(self, known):
+        return {k: v for k, v in self.counters.items() if known.get(k, 0) < v}
 
 class PNCounter():
-    def __init__(self, inc = Counter(), dec = Counter()):
-        self.inc = inc
-        self.dec = dec
+    def __init__(self, inc = None, dec = None):
+        self.inc = inc if inc is not None else Counter()
+        self.dec = dec if dec is not None else Counter()
 
     def from_json(self, json):
         return PNCounter(self.inc.from_json(json['inc']), self.dec.from_json(json['dec']))
@@ -53,30 +71,76 @@ class PNCounter():
 
     def add(self, node_id, delta):
         if 0 <= delta:
-            return PNCounter(self.inc.add(node_id, delta), self.dec)
+            self.inc.add(node_id, delta)
         else:
-            return PNCounter(self.inc, self.dec.add(node_id, -1 * delta))
+            self.dec.add(node_id, -1 * delta)
+        return self
+
+    # Merges a full or partial to_json() value in place
+    def merge_json(self, json):
+        inc_changed = self.inc.merge_entries(json.get('inc', {}))
+        dec_changed = self.dec.merge_entries(json.get('dec', {}))
+        return inc_changed or dec_changed
+
+    # The partial to_json() value a replica that knows `known` is missing,
+    # or None if it is up to date
+    def delta_after(self, known):
+        delta = {'inc': self.inc.entries_after(known['inc']), 'dec': self.dec.entries_after(known['dec'])}
+        return delta if delta['inc'] or delta['dec'] else None
 
     
 
+# Replicates per-node counter entries. Entries only grow, so an entry's value
+# doubles as its version: for every peer we track the values it is known to
+# have (from its acks and from what it sent us) and only ship entries that
+# are ahead. Replication runs soon after state changes and otherwise only
+# every IDLE_INTERVAL to retransmit anything still unacked.
 class CounterServer():
+    CHECK_INTERVAL = 0.1 # seconds between checks for changed state
+    IDLE_INTERVAL = 5 # seconds between retransmissions when nothing changed
+
     def __init__(self):
-        self.node = Node()
+        self.node = create_node()
         self.lock = threading.Lock()
         self.crdt = PNCounter()            
+        self.known = dict() # peer -> {'inc': {node: value}, 'dec': {...}} it has
+        self.dirty = False
+        self.last_replication = 0
         self.node.handlers['add'] = lambda request: self.add(request)
         self.node.handlers['read'] = lambda request: self.read(request)
         self.node.handlers['replicate'] = lambda request: self.merge(request)
-        self.node.every(self.replicate_counters, 5)
+        self.node.handlers['replicate_ok'] = lambda request: self.replicated(request)
+        self.node.every(self.replicate_counters, CounterServer.CHECK_INTERVAL)
+
+    def known_by(self, node_id):
+        return self.known.setdefault(node_id, {'inc': dict(), 'dec': dict()})
+
+    def learn(self, node_id, value):
+        known = self.known_by(node_id)
+        for kind in ('inc', 'dec'):
+            for k, v in value.get(kind, {}).items():
+                known[kind][k] = max(known[kind].get(k, 0), v)
 
-        
     def replicate_counters(self):
-        self.node.log(f'Replicating counters: {self.crdt.to_json()}')
-        for node_id in self.node.node_ids:
-            if node_id != self.node.node_id:
-                response = self.node.generate_response('replicate', node_id)
-                response['body']['value'] = self.crdt.to_json()
-                self.node.send(response)
+        now = self.node.now()
+        with self.lock:
+            if not self.dirty and now - self.last_replication < CounterServer.IDLE_INTERVAL:
+                return
+            self.dirty = False
+            self.last_replication = now
+            deltas = dict()
+            for node_id in self.node.other_node_ids():
+                delta = self.crdt.delta_after(self.known_by(node_id))
+                if delta:
+                    deltas[node_id] = delta
+
+        for node_id, delta in deltas.items():
+            self.node.debug('Replicating counters to %s: %s', node_id, delta, category='replicate')
+            self.node.send(self.node.generate_response('replicate', node_id, {'value': delta}))
+
+    def replicated(self, request):
+        with self.lock:
+            self.learn(request['src'], request['body']['value'])
 
     def read(self, request):
         with self.lock:
@@ -85,14 +149,19 @@ class CounterServer():
             self.node.reply(response, request)
 
     def merge(self, request):
+        value = request['body']['value']
         with self.lock:
-            other = self.crdt.from_json(request['body']['value'])
-            self.crdt = self.crdt.merge(other)
-            self.node.log(f'Using  {request["body"]["value"]} Replicated counters: {self.crdt.read()}')
+            if self.crdt.merge_json(value):
+                self.dirty = True
+            # the sender has everything it sent us
+            self.learn(request['src'], value)
+            self.node.debug('Using %s Replicated counters: %s', value, self.crdt.read(), category='merge')
+        self.node.send(self.node.generate_response('replicate_ok', request['src'], {'value': value}))
 
     def add(self, request):
         with self.lock:
             self.crdt = self.crdt.add(self.node.node_id, request['body']['delta'])
+            self.dirty = True
         self.node.reply(self.node.generate_response('add_ok', request['src']), request)
                     
 
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import threading
-from node import Node
+from node import create_node
 from node import RPCError
 from id_gen import IDGen
 from immutable_map import Map
@@ -15,42 +15,42 @@ class State():
     def transact(self, txn):
         body = {'key': State.KEY} 
         resp = self.node.sync_rpc('lin-kv', body, 'read')
-        self.node.log(f'#####ReadData {State.KEY}: {resp}')
+        self.node.debug('#####ReadData %s: %s', State.KEY, resp, category='txn')
         saved = True if resp['body'].get('value') else False
         has_existing_value = True if resp['body'].get('value') else False
         map_id = resp['body']['value'] if has_existing_value else self.id_gen.new_id()
         map_value = None if has_existing_value else {}
         map = Map(self.node, self.id_gen, map_id, saved, map_value)
         
-        self.node.log(f'#####from_json {map.map}')                         
+        self.node.debug('#####from_json %s', map.map, category='txn')                         
         
         txn_resp, map_resp = map.transact(txn)
         
-        self.node.log(f"@map_resp {map_resp}")
+        self.node.debug('@map_resp %s', map_resp, category='txn')
 
         if map.id != map_resp.id:
             #Save all thunks
             map_resp.save()
             body = body | {'from': map.id, 'to': map_resp.id, 'create_if_not_exists': 'true'}
-            self.node.log(f'#####PCPCPCPC sending response with body: {body}')
+            self.node.debug('#####PCPCPCPC sending response with body: %s', body, category='txn')
             resp = self.node.sync_rpc('lin-kv', body, 'cas')       
 
             if resp['body']['type'] != 'cas_ok':
-                self.node.log(f"@error for cas {resp}")
+                self.node.warn('@error for cas %s', resp, category='txn')
                 raise RPCError.txn_conflict(f'CAS failed for {State.KEY}')
                 
         return txn_resp
 
 class Transactor():    
     def __init__(self):
-        self.node = Node()
+        self.node = create_node()
         self.lock = threading.Lock()
         self.state = State(self.node, IDGen(self.node))        
         self.node.handlers['txn'] = self.transact
 
     def transact(self, request):
         txn = request['body']['txn']
-        self.node.log(f'Handling transaction: {txn}')
+        self.node.debug('Handling transaction: %s', txn, category='txn')
         txn_resp = []
         with self.lock:
             txn_resp = self.state.transact(txn)
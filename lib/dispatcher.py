@@ -0,0 +1,68 @@
+import itertools
+import queue
+import threading
+import time
+
+
+# Runs handlers on a fixed set of worker threads fed by a bounded priority
+# queue. Lower priority values run first; equal priorities run in FIFO order.
+class Dispatcher():
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+    def __init__(self, name, workers = 16, max_queue = 4096):
+        self.name = name
+        # put() blocks once max_queue tasks are waiting, which pushes back on
+        # the stdin reader instead of growing without bound
+        self.queue = queue.PriorityQueue(max_queue)
+        self.sequence = itertools.count()
+        self.stats_lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.wait_stats = dict() # priority -> [count, total wait, max wait]
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.worker, name=f'{name}-{i}', daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, task, *args, priority = NORMAL):
+        with self.stats_lock:
+            self.submitted += 1
+        self.queue.put((priority, next(self.sequence), time.monotonic(), task, args))
+
+    def worker(self):
+        while True:
+            priority, _, enqueued_at, task, args = self.queue.get()
+            wait = time.monotonic() - enqueued_at
+            with self.stats_lock:
+                stats = self.wait_stats.setdefault(priority, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += wait
+                stats[2] = max(stats[2], wait)
+            try:
+                task(*args)
+            finally:
+                with self.stats_lock:
+                    self.completed += 1
+                self.queue.task_done()
+
+    # Blocks until every submitted task has finished
+    def drain(self):
+        self.queue.join()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'name': self.name,
+                'workers': len(self.threads),
+                'depth': self.queue.qsize(),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'wait': {p: {'count': c, 'avg': total / c, 'max': max_wait}
+                         for p, (c, total, max_wait) in self.wait_stats.items()}
+            }
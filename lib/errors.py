@@ -0,0 +1,27 @@
+class RPCError(BaseException):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+        super().__init__(self.message)
+    
+    @staticmethod 
+    def timeout(msg): return RPCError(0, msg)
+    @staticmethod 
+    def not_supported(msg): return RPCError(10, msg)
+    @staticmethod 
+    def temporarily_unavailable(msg): return RPCError(11, msg)
+    @staticmethod 
+    def malformed_request(msg): return RPCError(12, msg)
+    @staticmethod 
+    def crash(msg): return RPCError(13, msg)
+    @staticmethod 
+    def abort(msg): return RPCError(14, msg)
+    @staticmethod 
+    def key_does_not_exist(msg): return RPCError( 20, msg)
+    @staticmethod 
+    def precondition_failed(msg): return RPCError( 22, msg)
+    @staticmethod 
+    def txn_conflict(msg): return RPCError(30, msg)
+
+    def to_json(self):
+        return {'type': "error", 'code': self.code, 'text': self.message}
@@ -1,49 +1,85 @@
 #!/usr/bin/env python
 
 import threading
-from node import Node
+from int_set import IntSet
+from node import create_node
 
 
+# add mutates in place; callers serialise access with their own lock.
+# merge still returns a new GSet.
 class GSet():
-    def __init__(self, messages = set()):
-        self.messages = messages
+    def __init__(self, messages = None):
+        self.messages = messages if messages is not None else IntSet()
 
     def from_json(self, json_array):
-        return GSet(set(json_array))
+        return GSet(IntSet(json_array))
 
     def to_json(self):
-        return list(self.messages)
+        return self.messages.to_list()
 
     def read(self):
-        return list(self.messages)
+        return self.messages.to_list()
 
     def merge(self, other):
         return GSet(self.messages.union(other.messages))
 
     def add(self, element):
-        local = self.messages.copy()
-        local.add(element)
-        return GSet(local)
+        self.messages.add(element)
+        return self
     
 
+# Replicates with delta state: every element this node learns, locally or
+# from a peer, is appended to self.added. Each peer is sent the part of that
+# stream it has not acked yet, or the full set when the delta would be larger
+# than half of it.
 class GSetServer():
     def __init__(self):
-        self.node = Node()
+        self.node = create_node()
         self.lock = threading.Lock()
         self.crdt = GSet()            
+        self.added = [] # elements in the order this node learned them
+        self.added_base = 0 # stream position of self.added[0]
+        self.acked = dict() # peer -> stream position it has acked
         self.node.handlers['add'] = lambda request: self.add(request)
         self.node.handlers['read'] = lambda request: self.read(request)
         self.node.handlers['replicate'] = lambda request: self.merge(request)
+        self.node.handlers['replicate_ok'] = lambda request: self.replicated(request)
         self.node.every(self.replicate_messages, 5)
 
         
     def replicate_messages(self):
-        self.node.log(f'Replicating messages: {self.crdt.to_json()}')
-        for node_id in self.node.node_ids:
-            if node_id != self.node.node_id:
-                response = self.node.generate_response('replicate', node_id)
-                response['body']['value'] = self.crdt.to_json()
-                self.node.send(response)
+        sent = 0
+        full = 0
+        for node_id in self.node.other_node_ids():
+            with self.lock:
+                position = self.added_base + len(self.added)
+                acked = self.acked.get(node_id)
+                if acked == position:
+                    continue
+                if acked is None or acked < self.added_base or len(self.crdt.messages) < 2 * (position - acked):
+                    value = self.crdt.to_json()
+                    full += 1
+                else:
+                    value = self.added[acked - self.added_base:]
+            response = self.node.generate_response('replicate', node_id, {'value': value, 'position': position})
+            sent += self.node.send(response)
+        if sent:
+            self.node.log(f'Replication round sent {sent} bytes ({full} full states)')
+
+    def replicated(self, request):
+        with self.lock:
+            node_id = request['src']
+            self.acked[node_id] = max(self.acked.get(node_id, 0), request['body']['position'])
+            self.trim()
+
+    # Drops the part of the stream every peer has acked, and anything older
+    # than half the set since such peers get the full state anyway
+    def trim(self):
+        keep_from = min(self.acked.get(n, 0) for n in self.node.other_node_ids())
+        keep_from = max(keep_from, self.added_base + len(self.added) - len(self.crdt.messages) // 2)
+        if self.added_base < keep_from:
+            del self.added[:keep_from - self.added_base]
+            self.added_base = keep_from
 
     def read(self, request):
         with self.lock:
@@ -54,12 +90,18 @@ class GSetServer():
     def merge(self, request):
         with self.lock:
             other = self.crdt.from_json(request['body']['value'])
+            self.added.extend(other.messages.difference(self.crdt.messages))
             self.crdt = self.crdt.merge(other)
-            self.node.log(f'Using  {request["body"]["value"]} Replicated messages: {self.crdt.read()}')
+            self.node.debug('Merged %d messages, now have %d', len(request['body']['value']), len(self.crdt.messages), category='merge')
+        response = self.node.generate_response('replicate_ok', request['src'], {'position': request['body']['position']})
+        self.node.send(response)
 
     def add(self, request):
+        element = request['body']['element']
         with self.lock:
-            self.crdt = self.crdt.add(request['body']['element'])
+            if element not in self.crdt.messages:
+                self.crdt = self.crdt.add(element)
+                self.added.append(element)
         self.node.reply(self.node.generate_response('add_ok', request['src']), request)
                     
 
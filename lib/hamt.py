@@ -0,0 +1,143 @@
+# Persistent hash array mapped trie. set() returns a new HAMT that shares
+# every untouched branch with the old one, so an update copies at most
+# one 32-slot array per level (about log32(n) of them) instead of the
+# whole map, and old versions stay valid. Safe to share between threads.
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_MASK = (1 << 64) - 1
+
+
+# Interior node: bitmap marks which of the 32 slots are present, array
+# holds them in slot order. A slot is a (key, value) pair, a _Node or a
+# _Collision.
+class _Node():
+    __slots__ = ('bitmap', 'array')
+
+    def __init__(self, bitmap, array):
+        self.bitmap = bitmap
+        self.array = array
+
+
+# Pairs whose keys have the same full hash
+class _Collision():
+    __slots__ = ('hash', 'pairs')
+
+    def __init__(self, hash, pairs):
+        self.hash = hash
+        self.pairs = pairs
+
+
+def _hash(key):
+    return hash(key) & HASH_MASK
+
+
+def _get(node, shift, h, key, default):
+    while True:
+        bit = 1 << ((h >> shift) & MASK)
+        if not node.bitmap & bit:
+            return default
+        child = node.array[(node.bitmap & (bit - 1)).bit_count()]
+        if isinstance(child, _Node):
+            node = child
+            shift += BITS
+        elif isinstance(child, _Collision):
+            for k, v in child.pairs:
+                if k == key:
+                    return v
+            return default
+        else:
+            return child[1] if child[0] == key else default
+
+
+# Returns (new node, whether key was added rather than replaced)
+def _set(node, shift, h, key, value):
+    bit = 1 << ((h >> shift) & MASK)
+    index = (node.bitmap & (bit - 1)).bit_count()
+    if not node.bitmap & bit:
+        array = node.array[:index] + [(key, value)] + node.array[index:]
+        return _Node(node.bitmap | bit, array), True
+
+    child = node.array[index]
+    if isinstance(child, _Node):
+        new_child, added = _set(child, shift + BITS, h, key, value)
+    elif isinstance(child, _Collision):
+        if child.hash == h:
+            pairs = [(k, v) for k, v in child.pairs if k != key]
+            added = len(pairs) == len(child.pairs)
+            new_child = _Collision(h, pairs + [(key, value)])
+        else:
+            new_child = _split(shift + BITS, child, child.hash, (key, value), h)
+            added = True
+    elif child[0] == key:
+        new_child, added = (key, value), False
+    else:
+        child_hash = _hash(child[0])
+        if child_hash == h:
+            new_child = _Collision(h, [child, (key, value)])
+        else:
+            new_child = _split(shift + BITS, child, child_hash, (key, value), h)
+        added = True
+
+    array = list(node.array)
+    array[index] = new_child
+    return _Node(node.bitmap, array), added
+
+
+# A node holding two slots whose hashes differ
+def _split(shift, a, a_hash, b, b_hash):
+    a_slot = (a_hash >> shift) & MASK
+    b_slot = (b_hash >> shift) & MASK
+    if a_slot == b_slot:
+        return _Node(1 << a_slot, [_split(shift + BITS, a, a_hash, b, b_hash)])
+    array = [a, b] if a_slot < b_slot else [b, a]
+    return _Node((1 << a_slot) | (1 << b_slot), array)
+
+
+def _items(node):
+    for child in node.array:
+        if isinstance(child, _Node):
+            yield from _items(child)
+        elif isinstance(child, _Collision):
+            yield from child.pairs
+        else:
+            yield child
+
+
+class HAMT():
+    def __init__(self, root = None, count = 0):
+        self.root = _Node(0, []) if root is None else root
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return _get(self.root, 0, _hash(key), key, _MISSING) is not _MISSING
+
+    def __iter__(self):
+        for key, _ in _items(self.root):
+            yield key
+
+    def __repr__(self):
+        return f'HAMT({dict(self.items())})'
+
+    def get(self, key, default = None):
+        return _get(self.root, 0, _hash(key), key, default)
+
+    def set(self, key, value):
+        root, added = _set(self.root, 0, _hash(key), key, value)
+        return HAMT(root, self.count + 1 if added else self.count)
+
+    def items(self):
+        return _items(self.root)
+
+    @staticmethod
+    def from_items(pairs):
+        result = HAMT()
+        for key, value in pairs:
+            result = result.set(key, value)
+        return result
+
+
+_MISSING = object()
@@ -0,0 +1,78 @@
+import os
+import struct
+import zlib
+
+
+# Raft's term and vote as an append-only file of records, each a header
+# (payload length, crc32) followed by {term, voted_for} as the codec
+# encodes it. The last intact record wins. Like SegmentLog, records reach
+# the page cache as soon as they are written and sync() makes them
+# durable; once the file reaches max_bytes it is rewritten down to one
+# record.
+#
+# Not thread-safe; the Raft lock covers it.
+class HardState():
+    HEADER = struct.Struct('>II')
+    FILE = 'state'
+
+    def __init__(self, directory, codec, max_bytes = 64 * 1024):
+        self.path = os.path.join(directory, HardState.FILE)
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self.fd = None
+        self.size = 0
+        self.dirty = False
+        os.makedirs(directory, exist_ok=True)
+
+    # Returns the last intact {term, voted_for} record, or None
+    def recover(self):
+        state = None
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset + HardState.HEADER.size <= len(data):
+                length, crc = HardState.HEADER.unpack_from(data, offset)
+                start = offset + HardState.HEADER.size
+                payload = data[start:start + length]
+                if len(payload) < length or crc != zlib.crc32(payload):
+                    break
+                state = self.codec.decode(payload)
+                offset = start + length
+            if offset < len(data):
+                os.truncate(self.path, offset)
+            self.size = offset
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return state
+
+    def record(self, term, voted_for):
+        payload = self.codec.encode({'term': term, 'voted_for': voted_for})
+        record = HardState.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        if self.max_bytes <= self.size:
+            self.rewrite(record)
+            return
+        os.write(self.fd, record)
+        self.size += len(record)
+        self.dirty = True
+
+    # Replaces the file with just record, durably
+    def rewrite(self, record):
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.size = len(record)
+        self.dirty = False
+        fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def sync(self):
+        if self.dirty:
+            os.fsync(self.fd)
+            self.dirty = False
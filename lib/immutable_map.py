@@ -13,7 +13,7 @@ class Map():
         return f'{self.map}'
         
     def from_json(self, json):
-        self.node.log(f"inside:from_json {json}")
+        self.node.debug('inside:from_json %s', json, category='txn')
         pairs = json if json else []
         m = {}
         for k, id in pairs:
@@ -58,7 +58,7 @@ class Map():
                     time.sleep(0.01)
 
     def save_self(self):
-        self.node.log(f"@saving_self with id: {self.id}")
+        self.node.debug('@saving_self with id: %s', self.id, category='txn')
         while not self.saved:
             body = {'key': self.id, 'value': self.to_json()}
             resp = self.node.sync_rpc('lww-kv', body, 'write')
@@ -88,9 +88,9 @@ class Map():
     
 
     def assoc(self, key, value):
-        self.node.log(f"@assoc {key} {value}")
+        self.node.debug('@assoc %s %s', key, value, category='txn')
         thunk = Thunk(self.node, self.id_gen.new_id(), value, False, self.id_gen)
-        self.node.log(f"@thunk {thunk}")
+        self.node.debug('@thunk %s', thunk, category='txn')
         merged = self.map.copy() if self.map else {}
         merged[key] = thunk
         return Map(self.node, self.id_gen, self.id_gen.new_id(), False, merged)
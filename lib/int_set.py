@@ -0,0 +1,125 @@
+import bisect
+
+# A set of integers stored as sorted, disjoint, non-adjacent inclusive
+# [lo, hi] intervals. Near-sequential ids collapse into a few intervals, so
+# memory follows the number of gaps rather than the number of elements.
+# Not thread-safe; callers hold their own lock.
+class IntSet():
+    def __init__(self, items = None):
+        self.starts = [] # interval lower bounds, sorted
+        self.ends = [] # matching upper bounds
+        self.count = 0
+        self.snapshot = None # cached to_list(), dropped on every change
+        if items is not None:
+            self.update(items)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, i):
+        index = bisect.bisect_right(self.starts, i) - 1
+        return 0 <= index and i <= self.ends[index]
+
+    def __iter__(self):
+        for lo, hi in zip(self.starts, self.ends):
+            yield from range(lo, hi + 1)
+
+    def __repr__(self):
+        return f'IntSet({self.ranges()})'
+
+    # Adds i and returns True if it was not present yet
+    def add(self, i):
+        index = bisect.bisect_right(self.starts, i) - 1
+        if 0 <= index and i <= self.ends[index]:
+            return False
+
+        joins_left = 0 <= index and self.ends[index] + 1 == i
+        joins_right = index + 1 < len(self.starts) and self.starts[index + 1] - 1 == i
+        if joins_left and joins_right:
+            self.ends[index] = self.ends[index + 1]
+            del self.starts[index + 1]
+            del self.ends[index + 1]
+        elif joins_left:
+            self.ends[index] = i
+        elif joins_right:
+            self.starts[index + 1] = i
+        else:
+            self.starts.insert(index + 1, i)
+            self.ends.insert(index + 1, i)
+        self.count += 1
+        self.snapshot = None
+        return True
+
+    def update(self, items):
+        if isinstance(items, IntSet):
+            for lo, hi in items.ranges():
+                self.add_range(lo, hi)
+        else:
+            for i in items:
+                self.add(i)
+
+    def add_range(self, lo, hi):
+        # merge with every interval that overlaps or touches [lo, hi]
+        left = bisect.bisect_left(self.ends, lo - 1)
+        right = bisect.bisect_right(self.starts, hi + 1)
+        if left < right:
+            lo = min(lo, self.starts[left])
+            hi = max(hi, self.ends[right - 1])
+        removed = sum(e - s + 1 for s, e in zip(self.starts[left:right], self.ends[left:right]))
+        self.starts[left:right] = [lo]
+        self.ends[left:right] = [hi]
+        added = hi - lo + 1 - removed
+        if added:
+            self.count += added
+            self.snapshot = None
+
+    @staticmethod
+    def from_ranges(ranges):
+        result = IntSet()
+        for lo, hi in ranges:
+            result.add_range(lo, hi)
+        return result
+
+    # Sorted list of the elements of self that are not in other
+    def difference(self, other):
+        result = []
+        j = 0
+        for lo, hi in zip(self.starts, self.ends):
+            i = lo
+            while j < len(other.starts) and other.ends[j] < i:
+                j += 1
+            while i <= hi:
+                if j < len(other.starts) and other.starts[j] <= hi:
+                    if i < other.starts[j]:
+                        result.extend(range(i, other.starts[j]))
+                    i = other.ends[j] + 1
+                    if other.ends[j] <= hi:
+                        j += 1
+                else:
+                    result.extend(range(i, hi + 1))
+                    break
+        return result
+
+    def union(self, other):
+        result = self.copy()
+        result.update(other)
+        return result
+
+    def copy(self):
+        result = IntSet()
+        result.starts = list(self.starts)
+        result.ends = list(self.ends)
+        result.count = self.count
+        result.snapshot = self.snapshot
+        return result
+
+    # Inclusive [lo, hi] intervals; also the anti-entropy digest format
+    def ranges(self):
+        return [[lo, hi] for lo, hi in zip(self.starts, self.ends)]
+
+    # Sorted list of every element, built once per change. Callers must not
+    # mutate it.
+    def to_list(self):
+        if self.snapshot is None:
+            self.snapshot = list(self)
+        return self.snapshot
@@ -0,0 +1,58 @@
+import json
+import os
+import random
+import time
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warn': WARN, 'error': ERROR}
+
+
+# Leveled logger for a node. Messages use %-style placeholders and are only
+# formatted once the level is enabled and the category passed sampling, so a
+# disabled debug call costs one comparison.
+#
+# Configured from the environment:
+#   MAELSTROM_LOG_LEVEL   debug | info | warn | error (default info)
+#   MAELSTROM_LOG_SAMPLE  per category sample rates, e.g. "send=0.01,recv=0.1"
+#   MAELSTROM_LOG_SINK    text (default), jsonl for JSON lines on stderr, or
+#                         jsonl:<path> for JSON lines in a file
+class Logger():
+    def __init__(self, node, writer, level = None, sample = None, sink = None):
+        self.node = node
+        self.writer = writer
+        self.level = LEVELS[level or os.environ.get('MAELSTROM_LOG_LEVEL', 'info').lower()]
+        self.sample = sample if sample is not None else self.parse_sample(os.environ.get('MAELSTROM_LOG_SAMPLE', ''))
+        sink = sink or os.environ.get('MAELSTROM_LOG_SINK', 'text')
+        self.structured = sink.startswith('jsonl')
+        self.stream = writer.err
+        if sink.startswith('jsonl:'):
+            self.stream = open(sink[len('jsonl:'):], 'a')
+
+    @staticmethod
+    def parse_sample(spec):
+        sample = dict()
+        for part in filter(None, spec.split(',')):
+            category, rate = part.split('=')
+            sample[category.strip()] = float(rate)
+        return sample
+
+    def enabled(self, level):
+        return self.level <= level
+
+    def log(self, level, category, message, args):
+        if level < self.level:
+            return
+        rate = self.sample.get(category)
+        if rate is not None and rate <= random.random():
+            return
+
+        text = message % args if args else message
+        if self.structured:
+            record = {'ts': time.time(), 'node': self.node.node_id, 'level': level, 'category': category, 'message': text}
+            self.writer.write(self.stream, json.dumps(record, default=repr) + '\n')
+        else:
+            self.writer.write(self.stream, f'\nnode_id={self.node.node_id} : {text}')
@@ -1,86 +1,162 @@
 import sys
 import threading
 import json
-import select
+import os
 import time
+from errors import RPCError
 from promise import Promise
+from dispatcher import Dispatcher
+from writer import Writer
+from logger import Logger, DEBUG, INFO, WARN, ERROR
+from scheduler import Scheduler, Task
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class RPCError(BaseException):
-    def __init__(self, code, message):
-        self.code = code
-        self.message = message
-        super().__init__(self.message)
-    
-    @staticmethod 
-    def timeout(msg): return RPCError(0, msg)
-    @staticmethod 
-    def not_supported(msg): return RPCError(10, msg)
-    @staticmethod 
-    def temporarily_unavailable(msg): return RPCError(11, msg)
-    @staticmethod 
-    def malformed_request(msg): return RPCError(12, msg)
-    @staticmethod 
-    def crash(msg): return RPCError(13, msg)
-    @staticmethod 
-    def abort(msg): return RPCError(14, msg)
-    @staticmethod 
-    def key_does_not_exist(msg): return RPCError( 20, msg)
-    @staticmethod 
-    def precondition_failed(msg): return RPCError( 22, msg)
-    @staticmethod 
-    def txn_conflict(msg): return RPCError(30, msg)
-
-    def to_json(self):
-        return {'type': "error", 'code': self.code, 'text': self.message}
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
 
 
-class Node():
-    
+# Codecs turn a message into a single bytes buffer, newline included, and
+# parse one line of input (bytes or str) back into a message. Codecs whose
+# backend is not installed raise ImportError when constructed.
+class JSONCodec():
+    name = 'json'
+
+    def encode(self, message):
+        return json.dumps(message).encode() + b'\n'
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec():
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('orjson is not installed')
+
+    def encode(self, message):
+        return orjson.dumps(message, option=orjson.OPT_APPEND_NEWLINE)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgspecCodec():
+    name = 'msgspec'
+
     def __init__(self):
+        if msgspec is None:
+            raise ImportError('msgspec is not installed')
+        self.encoder = msgspec.json.Encoder()
+        self.decoder = msgspec.json.Decoder()
+
+    def encode(self, message):
+        return self.encoder.encode(message) + b'\n'
+
+    def decode(self, data):
+        return self.decoder.decode(data)
+
+
+CODECS = {'json': JSONCodec, 'orjson': OrjsonCodec, 'msgspec': MsgspecCodec}
+
+
+# Uses MAELSTROM_CODEC if set, otherwise the fastest installed backend. A
+# MAELSTROM_CODEC naming an unknown or missing backend fails here, at
+# startup, rather than on the first message.
+def default_codec():
+    name = os.environ.get('MAELSTROM_CODEC')
+    if name:
+        if name not in CODECS:
+            raise ValueError(f'MAELSTROM_CODEC: unknown codec {name!r}, expected one of {", ".join(CODECS)}')
+        try:
+            return CODECS[name]()
+        except ImportError as e:
+            raise ImportError(f'MAELSTROM_CODEC={name}: {e}') from e
+    if orjson is not None:
+        return OrjsonCodec()
+    if msgspec is not None:
+        return MsgspecCodec()
+    return JSONCodec()
+
+
+class Node():
+    RPC_TIMEOUT = 5 # default rpc deadline, in seconds
+
+    def __init__(self, workers = 16, reply_workers = 4, max_queue = 4096):
         self.node_id = None
         self.node_ids = None
         self.next_response_id = 0
         self.lock = threading.RLock()
-        self.log_lock = threading.Lock()
+        # stdout and stderr belong to the writer thread; self.lock only
+        # guards node state
+        self.writer = Writer()
+        self.logger = Logger(self, self.writer)
+        self.codec = default_codec()
         self.handlers = dict()
-        self.callbacks = dict()
-        self.periodic_tasks = dict() # key is duration
+        self.callbacks = dict() # msg_id -> Promise for the reply
+        # one thread runs periodic tasks and expires rpc deadlines
+        self.scheduler = Scheduler(lambda task, e: self.error('Task %s failed: %r', task.fn, e))
+        self.periodic_tasks = [] # Tasks registered with every(), started on init
+        self.started = False
+        # Requests and replies get separate pools so that handlers blocked in
+        # sync_rpc can never starve the callbacks that would wake them up.
+        self.dispatcher = Dispatcher('requests', workers, max_queue)
+        self.reply_dispatcher = Dispatcher('replies', reply_workers, max_queue)
+        self.priorities = dict() # message type -> Dispatcher priority
         self.init_handlers()
 
     def now(self):
         return time.time()
 
-    def every(self, task, delay):
-        self.periodic_tasks[delay] = task
-        
+    # Runs task every delay seconds once the node is initialised. Returns the
+    # scheduler Task, which can be cancelled and reports overrun statistics.
+    def every(self, task, delay, mode = Task.FIXED_RATE, jitter = 0):
+        task = Task(task, delay, mode, jitter)
+        with self.lock:
+            self.periodic_tasks.append(task)
+            if self.started:
+                self.scheduler.add(task)
+        return task
+
     def start_periodic_tasks(self):
-        for delay, task in self.periodic_tasks.items():
-            t = threading.Thread(target=self.periodic_task_runner, args=(task, delay))
-            t.start()
+        with self.lock:
+            self.started = True
+            for task in self.periodic_tasks:
+                self.scheduler.add(task)
 
-    def periodic_task_runner(self, task, delay):
-        while True:
-            task()
-            time.sleep(delay)
+    def task_stats(self):
+        return self.scheduler.stats()
 
     def other_node_ids(self):
         return list(filter(lambda x: x != self.node_id, self.node_ids))
         
-    # Sends a broadcast rpc request
-    # invokes handler on response
-    def brpc(self, body, handler):
+    # Sends a broadcast rpc request to every other node at once and invokes
+    # handler on each response as it arrives. Returns a Promise that resolves
+    # with the first `quorum` responses satisfying predicate (every response
+    # by default), or rejects once that can no longer happen.
+    def brpc(self, body, handler = None, action = 'request_vote', quorum = None, predicate = None, timeout = None):
+        promises = []
         for node_id in self.other_node_ids():
-            response = self.generate_response('request_vote', node_id, body)
-            p = Promise()
-            self.rpc(response, lambda resp: p.resolve(resp))
-            response = p.await_promise()
-            handler(response)
+            response = self.generate_response(action, node_id, dict(body))
+            # always pass a handler so AsyncNode returns a Promise, not a future
+            promises.append(self.rpc(response, handler or (lambda _: None), timeout))
+        return Promise.first_n(promises, len(promises) if quorum is None else quorum, predicate)
 
         
     def init_handlers(self):
         self.handlers['init'] = self.handle_init
         self.handlers['echo'] = self.handle_echo
+        self.priorities['init'] = Dispatcher.HIGH
+
+    def dispatch_stats(self):
+        return [self.dispatcher.stats(), self.reply_dispatcher.stats()]
 
     def handle_add(self, request, server):
         with server.lock:
@@ -119,17 +195,20 @@ class Node():
 
         if (new_message):
             neighbors = broadcast.neighbors.copy()            
-            self.log(f'Sending message to neighbors: {neighbors}')
+            self.debug('Sending message to neighbors: %s', neighbors, category='broadcast')
             neighbors.remove(request['src']) if request['src'] in neighbors else None
-            # send message to all neighbors
-            while neighbors:
-                for n in neighbors:
-                    response = self.generate_response('broadcast', n)
-                    response['body']['message'] = message
-                    callback = lambda resp: neighbors.remove(n) if (resp['body']['type'] == 'broadcast_ok' and n in neighbors) else None
-                    self.rpc(response, callback)
-                time.sleep(1)
-        self.log(f'Done with message: {message}')
+            for n in neighbors:
+                self.gossip(n, message)
+        self.debug('Done with message: %s', message, category='broadcast')
+
+    # Sends message to neighbor n once. Nothing waits for the ack, so a
+    # partition never holds a worker, and nothing retries: messages lost to
+    # a partition are recovered by the anti-entropy sync in Broadcast. The
+    # no-op handler keeps AsyncNode on promises rather than futures.
+    def gossip(self, n, message):
+        response = self.generate_response('broadcast', n)
+        response['body']['message'] = message
+        self.rpc(response, lambda resp: None)
 
 
     def handle_read(self, request, broadcast, message_key = 'messages', lock = None):
@@ -138,20 +217,30 @@ class Node():
             
         with lock:
             response = self.generate_response('read_ok', request['src'])
-            response['body'][message_key] = list(broadcast.messages)
+            response['body'][message_key] = broadcast.messages.to_list()
             self.reply(response, request)
 
     def handle_replicate(self, request, server):
         with server.lock:
             server.messages.union(request['body']['value'])
             
-    def log(self, message):
-        with self.log_lock:            
-            sys.stderr.write("\n")
-            sys.stderr.write(f'node_id={self.node_id} : {message}')
-            sys.stderr.flush()
+    # Logging helpers take %-style arguments that are only formatted when the
+    # level is enabled; category selects the sample rate, see Logger
+    def log(self, message, *args, category = None):
+        self.logger.log(INFO, category, message, args)
+
+    def debug(self, message, *args, category = None):
+        self.logger.log(DEBUG, category, message, args)
+
+    def warn(self, message, *args, category = None):
+        self.logger.log(WARN, category, message, args)
+
+    def error(self, message, *args, category = None):
+        self.logger.log(ERROR, category, message, args)
 
-    def generate_response(self, response_type, dest, body = dict()):
+    def generate_response(self, response_type, dest, body = None):
+        if body is None:
+            body = dict()
         response = dict()
         response['src'] = self.node_id
         response['dest'] = dest
@@ -160,27 +249,51 @@ class Node():
         return response
 
     
+    # Returns the number of bytes sent
     def send(self, response):
-        with self.lock:        
-            self.log(f'Sending response: {response}')            
-            json.dump(response, sys.stdout)
-            sys.stdout.write('\n')
-            sys.stdout.flush()
+        self.debug('Sending response: %s', response, category='send')
+        data = self.codec.encode(response)
+        self.writer.write_out(data)
+        return len(data)
 
     def reply(self, response, request):
         response['body']['in_reply_to'] = request['body']['msg_id']
         self.send(response)
 
     def parse_message(self, incoming):
-        return json.loads(incoming)
+        return self.codec.decode(incoming)
 
-    def rpc(self, response, handler):
+    # Sends a request and returns a Promise for the reply. handler, if given,
+    # runs with the reply. If no reply arrives within timeout seconds the
+    # callback is dropped and the promise rejects with RPCError.timeout.
+    def rpc(self, response, handler = None, timeout = None):
+        promise = Promise()
+        if handler:
+            promise.then(handler)
+        msg_id = self.register_callback(response, promise, timeout)
+        promise.on_cancel = lambda: self.callbacks.pop(msg_id, None)
+        self.send(response)
+        return promise
+
+    def register_callback(self, response, callback, timeout = None):
         with self.lock:
             self.next_response_id += 1
             msg_id = self.next_response_id
-            self.callbacks[msg_id] = handler
+            self.callbacks[msg_id] = callback
             response['body']['msg_id'] = msg_id
-            self.send(response)
+
+        self.scheduler.call_later(Node.RPC_TIMEOUT if timeout is None else timeout, lambda: self.reap_callback(msg_id))
+        return msg_id
+
+    def reap_callback(self, msg_id):
+        with self.lock:
+            callback = self.callbacks.pop(msg_id, None)
+        if callback is not None:
+            self.debug('RPC %s timed out', msg_id, category='callback')
+            self.expire_callback(msg_id, callback)
+
+    def expire_callback(self, msg_id, callback):
+        callback.reject(RPCError.timeout(f'RPC {msg_id} timed out'))
 
     def add_msg_id(self, response):
         with self.lock:
@@ -188,64 +301,100 @@ class Node():
             msg_id = self.next_response_id
             response['body']['msg_id'] = msg_id            
 
-    def sync_rpc(self, dest, body, action):
+    def sync_rpc(self, dest, body, action, timeout = None):
         response = self.generate_response(action, dest)
         response['body'] = response['body'] | body
-        p = Promise()
-        self.rpc(response, lambda resp: p.resolve(resp))
-        return p.await_promise()
+        # pass the promise's own callbacks so that AsyncNode, which returns
+        # a future for handler-less rpcs, hands back a Promise here too
+        promise = Promise()
+        self.rpc(response, promise.resolve, timeout).catch(promise.reject)
+        return promise.await_promise(timeout)
 
+    # Runs a request handler and turns exceptions into error replies, for
+    # requests that expect a reply
     def handler_exec(self, handler, request):
         try:
             handler(request)
         except RPCError as e:
+            if 'msg_id' not in request['body']:
+                raise
             response = self.generate_response('error', request['src'])
             response['body'] = e.to_json()
             self.reply(response, request)
         except Exception as e:
-            self.log(f'Exception handling {request}:\n{getattr(e, "message", repr(e))}')     
+            self.error('Exception handling %s:\n%s', request, getattr(e, 'message', repr(e)))
+            if 'msg_id' not in request['body']:
+                return
             response = self.generate_response('error', request['src'])
             response['body'] = RPCError.crash(getattr(e, 'message', repr(e))).to_json()
             self.reply(response, request)
         
 
-    def main(self):
+    def read_batches(self):
+        """Blocks until stdin has data, then yields every complete line that is
+        currently buffered so bursts of messages are parsed together."""
+        fd = sys.stdin.fileno()
+        pending = b''
         while True:
-            """Handles a message from stdin, if one is currently available."""
-            if sys.stdin not in select.select([sys.stdin], [], [], 0)[0]:
-                continue
-
-            line = sys.stdin.readline()
-            if not line:
-                continue
-
-            request = self.parse_message(line)
-            self.log(f'Received message: {request}')
-
-            with self.lock:                
-                request_type = request['body']['type']
-                handler = None
-
-                # check if its response of a broadcast from this node
-                if request['body'].get('in_reply_to'):
-                    in_reply_to = request['body'].get('in_reply_to')
-                    self.log(f'Handling callback for {in_reply_to} with available callbacks: {self.callbacks}')
-                    if in_reply_to in self.callbacks:                    
-                        handler = self.callbacks.pop(in_reply_to)
-                        self.log(f'Handling callback for {in_reply_to}')
-                    else:
-                        self.log('ignoring reply to {in_reply_to} with no callbacks')
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            batch = [line for line in lines if line.strip()]
+            if batch:
+                yield batch
+
+    def dispatch(self, request):
+        with self.lock:
+            request_type = request['body']['type']
+            handler = None
+            is_reply = False
+
+            # check if its response of a broadcast from this node
+            if request['body'].get('in_reply_to'):
+                is_reply = True
+                in_reply_to = request['body'].get('in_reply_to')
+                if in_reply_to in self.callbacks:
+                    handler = self.callbacks.pop(in_reply_to).resolve
+                    self.debug('Handling callback for %s', in_reply_to, category='callback')
                 else:
-                    handler = self.handlers.get(request_type)
-                    
-            def execute(request):
-                try:
-                    handler(request)
-                except(RPCError, Exception) as e:
-                    self.log(f'got exception {e}')
-            
-            if handler:
-                t = threading.Thread(target=execute, args=(request,))
-                t.start()
+                    self.debug('ignoring reply to %s with no callbacks', in_reply_to, category='callback')
             else:
-                raise Exception(f'Unable to find handler for request type: {request_type}')
+                handler = self.handlers.get(request_type)
+
+        def execute(request):
+            try:
+                if is_reply:
+                    handler(request)
+                else:
+                    self.handler_exec(handler, request)
+            except(RPCError, Exception) as e:
+                self.error('got exception %r', e)
+
+        if handler and is_reply:
+            self.reply_dispatcher.submit(execute, request)
+        elif handler:
+            priority = self.priorities.get(request_type, Dispatcher.NORMAL)
+            self.dispatcher.submit(execute, request, priority = priority)
+        elif not is_reply:
+            raise Exception(f'Unable to find handler for request type: {request_type}')
+
+    def main(self):
+        for batch in self.read_batches():
+            requests = [self.parse_message(line) for line in batch]
+            for request in requests:
+                self.debug('Received message: %s', request, category='recv')
+                self.dispatch(request)
+        # stdin closed; let in-flight handlers finish before returning
+        self.dispatcher.drain()
+        self.writer.drain()
+
+
+# Picks the node runtime. Set MAELSTROM_RUNTIME=asyncio to run the same
+# handlers on the asyncio based AsyncNode.
+def create_node():
+    if os.environ.get('MAELSTROM_RUNTIME') == 'asyncio':
+        from async_node import AsyncNode
+        return AsyncNode()
+    return Node()
@@ -1,44 +1,124 @@
 import threading
+from errors import RPCError
 
 class Promise():
     WAITING = {}
-    TIMEOUT = 5
+    TIMEOUT = 5 # default for await_promise, in seconds
 
     def __init__(self):
         self.lock = threading.Lock()
         self.condition = threading.Condition(self.lock)
         self.value = Promise.WAITING
-        
-    def await_promise(self):
-        if self.value != Promise.WAITING:
-            return self.value
-        
+        self.error = None
+        self.callbacks = [] # (on_value, on_error) pairs run once settled
+        self.on_cancel = None
+
+    def done(self):
+        return self.value is not Promise.WAITING or self.error is not None
+
+    def await_promise(self, timeout = None):
         with self.condition:
-            self.condition.wait(Promise.TIMEOUT)
+            self.condition.wait_for(self.done, Promise.TIMEOUT if timeout is None else timeout)
 
-        if self.value != Promise.WAITING:
+        if self.error is not None:
+            raise self.error
+        if self.value is not Promise.WAITING:
             return self.value
-        else:
-            raise Exception("Promise timed out")
+        raise RPCError.timeout("Promise timed out")
 
     def resolve(self, value):
-        self.value = value
-        with self.condition:
-            self.condition.notify()
+        self.settle(value, None)
         return self
-    
-
-
-
-
-
-
-
-
-
-
-
-
 
+    def reject(self, error):
+        return self.settle(Promise.WAITING, error)
 
+    # Settles the promise once; later calls are ignored and return False
+    def settle(self, value, error):
+        with self.condition:
+            if self.done():
+                return False
+            self.value = value
+            self.error = error
+            callbacks, self.callbacks = self.callbacks, []
+            self.condition.notify_all()
+
+        for on_value, on_error in callbacks:
+            self.run_callback(on_value, on_error)
+        return True
+
+    def run_callback(self, on_value, on_error):
+        if self.error is None:
+            if on_value:
+                on_value(self.value)
+        elif on_error:
+            on_error(self.error)
+
+    # Registers callbacks for the value or the error. They run on the thread
+    # that settles the promise, or right away if it is already settled.
+    def then(self, on_value, on_error = None):
+        with self.condition:
+            if not self.done():
+                self.callbacks.append((on_value, on_error))
+                return self
+        self.run_callback(on_value, on_error)
+        return self
 
+    def catch(self, on_error):
+        return self.then(None, on_error)
+
+    def cancel(self):
+        if self.reject(RPCError.abort("Promise cancelled")) and self.on_cancel:
+            self.on_cancel()
+
+    # Resolves with every value, in order, or rejects with the first error
+    @staticmethod
+    def all(promises):
+        return Promise.first_n(promises, len(promises)).then_map(
+            lambda _: [p.value for p in promises])
+
+    # Resolves with the first value, or rejects once every promise failed
+    @staticmethod
+    def any(promises):
+        return Promise.first_n(promises, 1).then_map(lambda values: values[0])
+
+    # Resolves with the first n values that satisfy predicate, in arrival
+    # order, as soon as they are in. Rejects once too few promises remain
+    # for that to still happen.
+    @staticmethod
+    def first_n(promises, n, predicate = None):
+        result = Promise()
+        lock = threading.Lock()
+        accepted = []
+        remaining = [len(promises)]
+
+        if n <= 0:
+            return result.resolve([])
+
+        def settled(value, ok):
+            with lock:
+                remaining[0] -= 1
+                if ok and (predicate is None or predicate(value)):
+                    accepted.append(value)
+                if len(accepted) == n:
+                    values = list(accepted)
+                elif len(accepted) + remaining[0] < n:
+                    values = None
+                else:
+                    return
+            if values is not None:
+                result.resolve(values)
+            else:
+                result.reject(RPCError.abort(f"Only {len(accepted)} of {n} required responses"))
+
+        for p in promises:
+            p.then(lambda value: settled(value, True), lambda error: settled(error, False))
+        if len(promises) < n:
+            result.reject(RPCError.abort(f"Only {len(promises)} of {n} required responses"))
+        return result
+
+    # Returns a promise for fn(value) once this promise resolves
+    def then_map(self, fn):
+        mapped = Promise()
+        self.then(lambda value: mapped.resolve(fn(value)), mapped.reject)
+        return mapped
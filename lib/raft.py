@@ -1,38 +1,43 @@
 #!/usr/bin/env python
 
+import os
 import threading
-from node import Node
+from node import create_node
 from node import RPCError
+from dispatcher import Dispatcher
+from hamt import HAMT
+from segment_log import SegmentLog
+from hard_state import HardState
 from enum import Enum
 import random
 import time
 import math
 
+# The key/value state machine. Maps are immutable: apply returns the map
+# to use from then on, which shares all but O(log n) of its structure with
+# this one, so old maps stay valid as snapshots.
 class Map():
-    def __init__(self, data = dict()):
-        self.data = data
+    def __init__(self, data = None):
+        self.data = HAMT() if data is None else data
 
     def apply(self, request, node):       
         op = request['body']
         key = op['key']
         match op['type']:
             case "read":
-                if self.data.get(key):
-                    return [self, self.generate_response(node, 'read_ok', request['src'], {"type": "read_ok", "value": self.data[key]})] 
+                if key in self.data:
+                    return [self, self.generate_response(node, 'read_ok', request['src'], {"type": "read_ok", "value": self.data.get(key)})] 
                 else: 
                     return [self, self.generate_response(node, 'error',  request['src'], RPCError.key_does_not_exist('not found').to_json())]
             case "write":
-                updated_data = self.data.copy()
-                updated_data[key] = op['value'] 
-                return (Map(updated_data), self.generate_response(node, 'write_ok', request['src'], {"type": "write_ok"}))
+                return (Map(self.data.set(key, op['value'])), self.generate_response(node, 'write_ok', request['src'], {"type": "write_ok"}))
             case "cas":
-                if self.data.get(key):
-                    if self.data[key] == op['from']:
-                        updated_data = self.data.copy()
-                        updated_data[key] = op['to']
-                        return (Map(updated_data), self.generate_response(node, 'cas_ok', request['src'], {"type": "cas_ok"}))
+                if key in self.data:
+                    value = self.data.get(key)
+                    if value == op['from']:
+                        return (Map(self.data.set(key, op['to'])), self.generate_response(node, 'cas_ok', request['src'], {"type": "cas_ok"}))
                     else:
-                        return [self, self.generate_response(node, 'error',  request['src'], RPCError.precondition_failed(f"expected {op['from']} but got {self.data[key]}").to_json())]
+                        return [self, self.generate_response(node, 'error',  request['src'], RPCError.precondition_failed(f"expected {op['from']} but got {value}").to_json())]
                 else:
                     return [self, self.generate_response(node, 'error',  request['src'], RPCError.key_does_not_exist('not found').to_json())]
             case _:
@@ -40,40 +45,154 @@ class Map():
     
     def generate_response(self, node, type, dest, body):
             return node.generate_response(type, dest, body)
+
+    # Snapshot encoding; a list of pairs keeps integer keys intact
+    def to_json(self):
+        return list(self.data.items())
+
+    @staticmethod
+    def from_json(pairs):
+        return Map(HAMT.from_items(pairs))
             
 
 # Stores Raft entries, which are maps with a {:term} field. Not thread-safe; we
 # handle locking in the Raft class.
+#
+# Entries up to base_index have been compacted into a snapshot; entries[0]
+# is the entry at base_index + 1. The entry at base_index reads as an empty
+# entry of base_term, so it can still serve as prev_log_index.
+#
+# With a store (see open) every change is also written through to segment
+# files on disk; entries stay in memory too, bounded by compaction.
 class Log():
     def __init__(self, node):
         self.node = node
         self.entries = [{"term": 0, "op": None}]
+        self.sizes = [0] # encoded size of each entry, or None until batch needs it
+        self.base_index = 0
+        self.base_term = 0
+        self.store = None
+        self.durable_index = 0 # entries up to here are synced to the store
+
+    # Switches to store and replaces our entries with the ones it recovered.
+    # The store always keeps the record at base_index, so its first record
+    # is our base.
+    def open(self, store):
+        entries, sizes = store.recover()
+        self.store = store
+        if entries:
+            self.base_index = store.first_index
+            self.base_term = entries[0]['term']
+            self.entries = entries[1:]
+            self.sizes = sizes[1:]
+            self.durable_index = self.size()
+        else:
+            # a fresh store; the shared empty entry at index 1 is its base
+            store.reset(1, self.entries[0])
 
     def __getitem__(self, index):        
+        if index < 1 or index < self.base_index:
+            return None
+        if index == self.base_index:
+            return {"term": self.base_term, "op": None}
         try:
-            return self.entries[index - 1]
+            return self.entries[index - self.base_index - 1]
         except(IndexError):
             return None
     
+    # Entries are only encoded here when a store needs them written;
+    # otherwise batch measures them on the leader, the first time they are
+    # sent.
     def append(self, entries):
         self.entries.extend(entries)
+        if self.store:
+            encoded = [self.node.codec.encode(e) for e in entries]
+            self.sizes.extend(len(e) for e in encoded)
+            self.store.append(entries, encoded)
+        else:
+            self.sizes.extend(None for _ in entries)
         #self.node.log(f"Log: contains {self.entries} entries")
 
     def last(self):
+        if not self.entries:
+            return self[self.base_index]
         return self.entries[-1]
 
     def size(self):
-        return len(self.entries)
+        return self.base_index + len(self.entries)
     
     #Log truncation is important--we need to delete all mismatching log entries after the given index.
     def truncate(self, index):
-        self.entries = self.entries[:index]
-    
-    def from_index(self, index):
-        if index <= 0:
+        del self.entries[index - self.base_index:]
+        del self.sizes[index - self.base_index:]
+        if self.store:
+            self.store.truncate(index)
+            self.durable_index = min(self.durable_index, index)
+
+    # Drops every entry up to and including index, which must be applied
+    def compact(self, index):
+        if index <= self.base_index:
+            return
+        self.base_term = self[index]['term']
+        del self.entries[:index - self.base_index]
+        del self.sizes[:index - self.base_index]
+        self.base_index = index
+        if self.store:
+            self.store.compact(index)
+
+    # Replaces the whole log with a snapshot's last entry
+    def reset(self, index, term):
+        self.entries = []
+        self.sizes = []
+        self.base_index = index
+        self.base_term = term
+        if self.store:
+            self.store.reset(index, {"term": term, "op": None})
+            self.durable_index = min(self.durable_index, index)
+
+    def sync(self):
+        if self.store:
+            self.store.sync()
+            self.durable_index = self.size()
+
+    def durable_size(self):
+        return self.durable_index if self.store else self.size()
+
+    # First index of the run of entries sharing the term at index
+    def first_index_of_term(self, index):
+        term = self[index]['term']
+        while self.base_index + 1 < index and self[index - 1]['term'] == term:
+            index -= 1
+        return index
+
+    # Last index holding an entry of term, or None. Terms never decrease
+    # along the log, so we scan back from the end.
+    def last_index_of_term(self, term):
+        index = self.size()
+        while self.base_index < index and term < self[index]['term']:
+            index -= 1
+        entry = self[index]
+        if entry is not None and entry['term'] == term:
+            return index
+        return None
+
+    # Entries from index on, at most max_entries of them and at most
+    # max_bytes encoded, but always at least one if there is one
+    def batch(self, index, max_entries, max_bytes):
+        if index <= self.base_index:
             raise Exception(f"Illegal index {index}")
-            
-        return self.entries[index-1:]
+
+        start = index - self.base_index - 1
+        end = min(len(self.entries), start + max_entries)
+        total = 0
+        for i in range(start, end):
+            if self.sizes[i] is None:
+                self.sizes[i] = len(self.node.codec.encode(self.entries[i]))
+            total += self.sizes[i]
+            if max_bytes < total and start < i:
+                end = i
+                break
+        return self.entries[start:end]
 
 class State(Enum):
     Follower = 1,
@@ -83,7 +202,7 @@ class State(Enum):
 class Raft():
     def __init__(self):
         # Components
-        self.node = Node()
+        self.node = create_node()
         self.lock = threading.RLock()
         self.state_machine = Map()
         self.log = Log(self.node)
@@ -99,6 +218,59 @@ class Raft():
         self.heart_beat_interval = 1 # Time between heartbeats, in seconds
         self.min_replication_interval = 0.05 # Don't replicate TOO frequently
 
+        # Pipelining: append_entries requests in flight per follower, and
+        # how much one request may carry
+        self.max_inflight = 4
+        self.max_entries = 100
+        self.max_bytes = 64 * 1024
+
+        # Group commit: client requests are appended to the log in batches
+        # of up to batch_size, and a partial batch waits at most
+        # batch_linger seconds. Either way replication starts right away
+        # instead of on the next replication tick.
+        self.batch_size = int(os.environ.get('RAFT_BATCH_SIZE', 64))
+        self.batch_linger = float(os.environ.get('RAFT_BATCH_LINGER', 0.002))
+        self.pending_requests = []
+        self.batch_flush = None # scheduled flush of a partial batch
+
+        # Leader lease: followers refuse votes for election_timeout after
+        # hearing from the leader, so once a majority acked an
+        # append_entries sent at t nobody else can win an election before
+        # t + election_timeout. Until then the leader answers reads from its
+        # state machine without going through the log. lease_ratio leaves a
+        # margin for clock drift; RAFT_LEASE_READS=0 sends reads through the
+        # log again.
+        self.lease_reads = os.environ.get('RAFT_LEASE_READS', '1') != '0'
+        self.lease_ratio = 0.9
+        self.acked_at = None # A map of (other) nodes to when the last acked append_entries was sent
+        self.leader_contact = self.node.now() # When we last heard from a valid leader
+        self.pending_reads = [] # (read index, request) waiting for last_applied
+
+        # Snapshots: once snapshot_threshold entries past the log's base are
+        # applied, the state machine at last_applied becomes the snapshot
+        # and the log is compacted, keeping the last snapshot_trailing
+        # applied entries for followers that are only a little behind.
+        # Followers behind the log's base get the snapshot through
+        # install_snapshot. The state machine is immutable, so the snapshot
+        # is just a reference to it.
+        self.snapshot_threshold = int(os.environ.get('RAFT_SNAPSHOT_THRESHOLD', 1000))
+        self.snapshot_trailing = int(os.environ.get('RAFT_SNAPSHOT_TRAILING', 100))
+        self.snapshot = None # (last included index, last included term, state machine)
+
+        # With RAFT_LOG_DIR set the log, the latest snapshot and our term and
+        # vote are kept in RAFT_LOG_DIR/<node id> and recovered from there
+        # on init. Writes go out right away but are fsynced in groups:
+        # whatever depends on them (votes, acks, vote requests, our own
+        # match index as leader) waits for the next sync, which runs
+        # RAFT_FSYNC_INTERVAL seconds after the first write it covers, so
+        # everything written meanwhile shares one fsync.
+        self.log_dir = os.environ.get('RAFT_LOG_DIR')
+        self.segment_bytes = int(os.environ.get('RAFT_SEGMENT_BYTES', 4 * 1024 * 1024))
+        self.fsync_interval = float(os.environ.get('RAFT_FSYNC_INTERVAL', 0))
+        self.hard_state = None
+        self.awaiting_sync = [] # callbacks to run after the next sync
+        self.sync_task = None # the scheduled sync, if any
+
         self.election_deadline = self.node.now()  # Next election, in epoch seconds
         self.stepdown_deadline = self.node.now() # When to step down automatically.
         self.last_replication = self.node.now() # When did we last replicate?
@@ -108,25 +280,99 @@ class Raft():
         self.next_index = None # A map of nodes to the next index to replicate
         self.match_index = None # A map of (other) nodes to the highest log entry
                                 # known to be replicated on that node.
+        self.inflight = None # A map of (other) nodes to unanswered append_entries
 
 
         self.last_applied = 1
 
 
-        self.node.handlers['read'] = lambda request: self.client_req(request)
+        self.node.handlers['init'] = lambda request: self.handle_init(request)
+        self.node.handlers['read'] = lambda request: self.client_read(request)
         self.node.handlers['write'] = lambda request: self.client_req(request)
         self.node.handlers['cas'] = lambda request: self.client_req(request)
         self.node.handlers['request_vote'] = lambda request: self.grant_vote(request)
         self.node.handlers['append_entries'] = lambda request: self.handle_append_entries(request)
+        self.node.handlers['install_snapshot'] = lambda request: self.handle_install_snapshot(request)
+        # Raft's own RPCs must never queue behind client traffic
+        self.node.priorities['request_vote'] = Dispatcher.HIGH
+        self.node.priorities['append_entries'] = Dispatcher.HIGH
+        self.node.priorities['install_snapshot'] = Dispatcher.HIGH
 
 
-        self.node.every(lambda: self.leader_heart_beat(), 0.1)
+        # jitter spreads out elections across nodes
+        self.node.every(lambda: self.leader_heart_beat(), 0.1, jitter = 0.1)
         self.node.every(lambda: self.heart_beat(), self.heart_beat_interval)
         self.node.every(lambda: self.replicate_log(False), self.min_replication_interval)
         
 
+    # Opens the on-disk log before answering init, so a restarted node is
+    # back where it left off before it handles anything else
+    def handle_init(self, request):
+        if self.log_dir:
+            self.open_storage(os.path.join(self.log_dir, request['body']['node_id']))
+        self.node.handle_init(request)
+
+    def open_storage(self, directory):
+        with self.lock:
+            self.hard_state = HardState(directory, self.node.codec)
+            state = self.hard_state.recover()
+            if state:
+                self.term, self.voted_for = state['term'], state['voted_for']
+            store = SegmentLog(directory, self.node.codec, self.segment_bytes, fsync = False)
+            self.log.open(store)
+            snapshot = store.load_snapshot()
+            if snapshot:
+                index, last_term = snapshot['index'], snapshot['term']
+                self.state_machine = Map.from_json(snapshot['data'])
+                self.snapshot = (index, last_term, self.state_machine)
+                self.last_applied = index
+                self.commit_index = index
+                entry = self.log[index]
+                if entry is None or entry['term'] != last_term:
+                    # we stopped between saving a snapshot and resetting the log
+                    self.log.reset(index, last_term)
+            self.node.log(f"Recovered term {self.term}, log up to {self.log.size()} from {directory}, snapshot at {self.last_applied}")
+
+    def save_hard_state(self):
+        if self.hard_state:
+            self.hard_state.record(self.term, self.voted_for)
+
+    def unsynced(self):
+        return (self.log.store is not None and self.log.store.dirty) or (self.hard_state is not None and self.hard_state.dirty)
+
+    # Runs fn once everything written so far is durable: right away if it
+    # already is, otherwise after the next sync. Callbacks run in order.
+    def when_durable(self, fn):
+        with self.lock:
+            if not self.awaiting_sync and not self.unsynced():
+                fn()
+                return
+            self.awaiting_sync.append(fn)
+            if self.sync_task is None:
+                self.sync_task = self.node.scheduler.call_later(self.fsync_interval, self.sync_log)
+
+    def reply_durable(self, response, request):
+        self.when_durable(lambda: self.node.reply(response, request))
+
+    # One fsync for the log and one for the term and vote, for every write
+    # since the last sync
+    def sync_log(self):
+        with self.lock:
+            self.sync_task = None
+            self.log.sync()
+            if self.hard_state:
+                self.hard_state.sync()
+            callbacks, self.awaiting_sync = self.awaiting_sync, []
+            for fn in callbacks:
+                fn()
+
+    def save_snapshot(self):
+        if self.log.store:
+            index, last_term, state_machine = self.snapshot
+            self.log.store.save_snapshot({'index': index, 'term': last_term, 'data': state_machine.to_json()})
+
     def get_match_index(self):
-        return self.match_index | {self.node.node_id: self.log.size()}
+        return self.match_index | {self.node.node_id: self.log.durable_size()}
 
 
     def advance_state_machine(self):
@@ -135,14 +381,26 @@ class Raft():
                 #advance the applied index and apply that op
                 self.last_applied += 1
                 request = self.log[self.last_applied]['op']
-                self.node.log(f"Applying {request}")
+                self.node.debug('Applying %s', request, category='apply')
                 self.state_machine, response = self.state_machine.apply(request, self.node)
-                self.node.log(f"State machine resonse: {response}")
+                self.node.debug('State machine response: %s', response, category='apply')
 
                 if self.state == State.Leader:
                     # we are currently the leader, so we need to send a response to the client
                     self.node.reply(response, request)
 
+            self.serve_reads()
+            self.maybe_snapshot()
+
+    def maybe_snapshot(self):
+        with self.lock:
+            if self.last_applied - self.log.base_index < self.snapshot_threshold + self.snapshot_trailing:
+                return
+            self.snapshot = (self.last_applied, self.log[self.last_applied]['term'], self.state_machine)
+            self.save_snapshot()
+            self.log.compact(self.last_applied - self.snapshot_trailing)
+            self.node.log(f"Snapshot at {self.last_applied}, log compacted up to {self.log.base_index}")
+
 
     def handle_append_entries(self, request):
         with self.lock:
@@ -156,129 +414,351 @@ class Raft():
             }
 
             if body['term'] < self.term:
-                self.node.log(f"Ignoring {body} because it's in a later term")
+                self.node.debug("Ignoring %s because it's in a later term", body, category='append')
                 response = self.node.generate_response('append_entries_res', request['src'], response_body)
                 self.node.reply(response, request)
                 return
 
             # valid leader lets reset election deadline
             self.reset_election_deadline()
+            self.leader = body['leader_id']
+            self.leader_contact = self.node.now()
 
             # Check previous entry to see if it matches
             if body['prev_log_index'] <= 0:
                 raise RPCError.abort(f"Out of bounds previous log index {body['prev_log_index']}")
 
-            previous_log_entry = self.log[body['prev_log_index']]
+            # Entries up to our log's base are in our snapshot, hence
+            # committed, hence the same as the leader's; skip them
+            entries = body['entries']
+            prev_log_index = body['prev_log_index']
+            prev_log_term = body['prev_log_term']
+            if prev_log_index < self.log.base_index:
+                entries = entries[self.log.base_index - prev_log_index:]
+                prev_log_index = self.log.base_index
+                prev_log_term = self.log.base_term
+
+            previous_log_entry = self.log[prev_log_index]
 
             # If the previous entry doesn't exist, or if we disagree on its term, we'll reject this request
-            if previous_log_entry == None or previous_log_entry['term'] != body['prev_log_term']:
-                # We disagree on the previous term
-                self.node.log(f"We disagree on the previous term {previous_log_entry}")
+            if previous_log_entry == None or previous_log_entry['term'] != prev_log_term:
+                # We disagree on the previous term. Tell the leader where our
+                # log diverges so it can skip a whole term per round trip:
+                # the conflicting term and the first index we hold for it,
+                # or just our log size if the entry is missing.
+                self.node.debug('We disagree on the previous term %s', previous_log_entry, category='append')
+                if previous_log_entry == None:
+                    response_body['conflict_term'] = None
+                    response_body['conflict_index'] = self.log.size() + 1
+                else:
+                    response_body['conflict_term'] = previous_log_entry['term']
+                    response_body['conflict_index'] = self.log.first_index_of_term(prev_log_index)
                 response = self.node.generate_response('append_entries_res', request['src'], response_body)
-                self.node.reply(response, request)
-                self.leader = body['leader_id']
+                self.reply_durable(response, request)
                 return
             
-            # We agree on the previous log term; truncate and append
-            # lets remove all entries from the previous log index
-            # those entries are not not correct anymore according to leader.
-            #Log truncation is important--we need to delete all mismatching log entries after the given index.
-            self.log.truncate(body['prev_log_index'])
-            self.log.append(body['entries'])
-
-            # advance commit pointer
+            # We agree on the previous log term. Skip entries we already
+            # have; at the first entry whose term differs, delete it and all
+            # that follow, then append the rest. Only truncating on conflict
+            # matters with pipelining: a delayed, shorter request must not
+            # cut off entries a later request already appended.
+            index = prev_log_index + 1
+            for i, entry in enumerate(entries):
+                existing = self.log[index + i]
+                if existing is None or existing['term'] != entry['term']:
+                    self.log.truncate(index + i - 1)
+                    self.log.append(entries[i:])
+                    break
+
+            # advance commit pointer, up to the last entry this request covers
+            last_new_index = body['prev_log_index'] + len(body['entries'])
             if self.commit_index  < body['leader_commit']:
-                self.commit_index = min(self.log.size(), body['leader_commit'])
+                self.commit_index = max(self.commit_index, min(last_new_index, body['leader_commit']))
             # for followers
             self.advance_state_machine()
 
             # Ack the replication
             response_body['success'] = True
             response = self.node.generate_response('append_entries_res', request['src'], response_body)
-            self.node.reply(response, request)
+            self.reply_durable(response, request)
 
 
 
             
 
 
+    # Sends append_entries to every follower. next_index advances as soon as
+    # a request is sent, so up to max_inflight requests per follower carry
+    # successive batches without waiting for replies. A rejection or timeout
+    # rolls next_index back.
     def replicate_log(self, force):
         with self.lock:            
             # How long has it been since we last replicated?
             elapsed_time = self.node.now() - self.last_replication
             # We'll set this to true if we replicated to anyone
             replicated = False
-            # We need the current term to ensure we don't process responses in later
-            # terms.
-            term = self.term
 
-            
-            if self.state == State.Leader and self.min_replication_interval < elapsed_time:
+            if self.state == State.Leader and (force or self.min_replication_interval < elapsed_time):
                 # We're a leader, and enough time elapsed
                 for n in self.node.other_node_ids():
-                    # what entries we should append?
-                    n_index = self.next_index[n]
-                    self.node.log(f"Replicating from {n_index} to {n}")
-                    entries = self.log.from_index(n_index)
-
                     # if we haven't replicated in the heartbeat interval, we'll send this node an appendEntries message.
-                    if len(entries) > 0 or self.heart_beat_interval < elapsed_time:
-                        self.node.log(f"Replicating to {n}")
-                        replicated = True                        
-                        request_body = {
-                            'type': 'append_entries',
-                            'term': term,
-                            'leader_id': self.node.node_id,
-                            'entries': entries,
-                            'leader_commit': self.commit_index,
-                            'prev_log_index': n_index - 1,
-                            'prev_log_term': self.log[n_index - 1]['term']
-                        }
-                        
-                        response = self.node.generate_response('append_entries', n, request_body)
-
-                        def callback(result):
-                            body = result['body']
-                            self.node.log(f"Received {body} from {n}")
-                            self.maybe_step_down(body['term'])
-                            if self.state == State.Leader:
-                                self.reset_stepdown_deadline()
-                                if body.get('success'):
-                                    self.next_index[n] = max(self.next_index[n], (n_index + len(entries)))
-                                    self.match_index[n] = max(self.match_index[n], (n_index + len(entries) - 1))
-                                    self.node.log(f'Next index {self.next_index}')
-                                    self.advance_commit_index()
-                                else:
-                                    # We didn't match; back up our next index for this node
-                                    # this basically means lets try with previous log entry and see if that succeeds we will keep
-                                    # going back to ensure we can replicate all pending logs to the follower 
-                                    self.next_index[n] -=1 
-                                                    
-                        self.node.rpc(response, callback)
+                    heartbeat = self.heart_beat_interval < elapsed_time
+                    if self.next_index[n] <= self.log.base_index:
+                        # what this follower needs next is compacted away
+                        if not self.inflight[n]:
+                            self.send_snapshot(n)
+                            replicated = True
+                        continue
+                    while self.inflight[n] < self.max_inflight:
+                        entries = self.log.batch(self.next_index[n], self.max_entries, self.max_bytes)
+                        if not entries and not heartbeat:
+                            break
+                        self.send_append_entries(n, entries)
+                        replicated = True
+                        heartbeat = False
+                        if not entries:
+                            break
 
                 if replicated:
                     self.last_replication = self.node.now()                    
 
+    def send_append_entries(self, n, entries):
+        prev_log_index = self.next_index[n] - 1
+        term = self.term
+        sent_at = self.node.now()
+        self.node.debug('Replicating %s entries from %s to %s', len(entries), prev_log_index + 1, n, category='replicate')
+        request_body = {
+            'type': 'append_entries',
+            'term': term,
+            'leader_id': self.node.node_id,
+            'entries': entries,
+            'leader_commit': self.commit_index,
+            'prev_log_index': prev_log_index,
+            'prev_log_term': self.log[prev_log_index]['term']
+        }
+        self.next_index[n] = prev_log_index + 1 + len(entries)
+        self.inflight[n] += 1
+
+        response = self.node.generate_response('append_entries', n, request_body)
+        self.node.rpc(response,
+                      lambda result: self.handle_append_entries_res(n, term, prev_log_index, len(entries), result, sent_at),
+                      self.heart_beat_interval).catch(
+                      lambda error: self.append_entries_failed(n, term, prev_log_index))
+
+    def handle_append_entries_res(self, n, term, prev_log_index, count, result, sent_at):
+        with self.lock:
+            body = result['body']
+            self.node.debug('Received %s from %s', body, n, category='replicate')
+            self.maybe_step_down(body['term'])
+            if self.state != State.Leader or self.term != term:
+                return
+            self.inflight[n] = max(0, self.inflight[n] - 1)
+            self.reset_stepdown_deadline()
+            # success or not, the follower accepted us as leader for term
+            self.acked_at[n] = max(self.acked_at[n], sent_at)
+            if body.get('success'):
+                self.match_index[n] = max(self.match_index[n], prev_log_index + count)
+                self.next_index[n] = max(self.next_index[n], self.match_index[n] + 1)
+                self.node.debug('Next index %s', self.next_index, category='replicate')
+                self.advance_commit_index()
+            else:
+                # We didn't match; drop everything sent optimistically and
+                # retry from where the follower's hints say the logs diverge
+                self.rollback(n, self.conflict_next_index(body, prev_log_index))
+
+    def send_snapshot(self, n):
+        index, last_term, state_machine = self.snapshot
+        term = self.term
+        sent_at = self.node.now()
+        self.node.log(f"Installing snapshot at {index} on {n}")
+        request_body = {
+            'type': 'install_snapshot',
+            'term': term,
+            'leader_id': self.node.node_id,
+            'last_included_index': index,
+            'last_included_term': last_term,
+            'data': state_machine.to_json()
+        }
+        self.next_index[n] = index + 1
+        self.inflight[n] += 1
+
+        response = self.node.generate_response('install_snapshot', n, request_body)
+        self.node.rpc(response,
+                      lambda result: self.handle_install_snapshot_res(n, term, index, result, sent_at),
+                      self.election_timeout).catch(
+                      lambda error: self.install_snapshot_failed(n, term))
+
+    def handle_install_snapshot_res(self, n, term, index, result, sent_at):
+        with self.lock:
+            body = result['body']
+            self.maybe_step_down(body['term'])
+            if self.state != State.Leader or self.term != term:
+                return
+            self.inflight[n] = max(0, self.inflight[n] - 1)
+            self.reset_stepdown_deadline()
+            self.acked_at[n] = max(self.acked_at[n], sent_at)
+            self.match_index[n] = max(self.match_index[n], index)
+            self.next_index[n] = max(self.next_index[n], self.match_index[n] + 1)
+            self.advance_commit_index()
+
+    def install_snapshot_failed(self, n, term):
+        with self.lock:
+            if self.state != State.Leader or self.term != term:
+                return
+            self.inflight[n] = max(0, self.inflight[n] - 1)
+            self.rollback(n, self.match_index[n] + 1)
+
+    # Replaces our state with the leader's snapshot, unless we already
+    # applied that far. A log that agrees with the snapshot's last entry
+    # keeps the entries after it.
+    def handle_install_snapshot(self, request):
+        with self.lock:
+            body = request['body']
+            self.maybe_step_down(body['term'])
+            response_body = {'type': 'install_snapshot_res', 'term': self.term}
+            if self.term <= body['term']:
+                self.reset_election_deadline()
+                self.leader = body['leader_id']
+                self.leader_contact = self.node.now()
+
+                index = body['last_included_index']
+                last_term = body['last_included_term']
+                if self.last_applied < index:
+                    state_machine = Map.from_json(body['data'])
+                    self.snapshot = (index, last_term, state_machine)
+                    self.save_snapshot()
+                    entry = self.log[index]
+                    if entry is not None and entry['term'] == last_term:
+                        self.log.compact(index)
+                    else:
+                        self.log.reset(index, last_term)
+                    self.state_machine = state_machine
+                    self.last_applied = index
+                    self.commit_index = max(self.commit_index, index)
+                    self.node.log(f"Installed snapshot at {index}")
+                    self.advance_state_machine()
+
+            response = self.node.generate_response('install_snapshot_res', request['src'], response_body)
+            self.reply_durable(response, request)
+
+    # Where to resume replication after a rejection. If we have entries of
+    # the follower's conflicting term, resume after our last one; otherwise
+    # skip the follower's whole run of that term. Without hints, back up one.
+    def conflict_next_index(self, body, prev_log_index):
+        if 'conflict_index' not in body:
+            return prev_log_index
+        if body['conflict_term'] is not None:
+            last = self.log.last_index_of_term(body['conflict_term'])
+            if last is not None:
+                return min(last + 1, prev_log_index)
+        return min(body['conflict_index'], prev_log_index)
+
+    def append_entries_failed(self, n, term, prev_log_index):
+        with self.lock:
+            if self.state != State.Leader or self.term != term:
+                return
+            self.inflight[n] = max(0, self.inflight[n] - 1)
+            # the request or its reply was lost; resend from its first entry
+            self.rollback(n, prev_log_index + 1)
+
+    def rollback(self, n, next_index):
+        # index 1 is the shared empty entry, so 2 is as far back as we go
+        self.next_index[n] = max(self.match_index[n] + 1, 2, min(self.next_index[n], next_index))
+
+    # Reads skip the log while the leader holds a lease and has committed an
+    # entry of its own term, so commit_index covers every write acked by an
+    # earlier leader. Otherwise they go through the log like writes.
+    def client_read(self, request):
+        with self.lock:
+            if self.lease_reads and self.state == State.Leader and self.lease_valid():
+                read_index = self.commit_index
+                committed = self.log[read_index]
+                if committed is not None and committed['term'] == self.term:
+                    self.node.debug('Lease read at index %s', read_index, category='client')
+                    self.pending_reads.append((read_index, request))
+                    self.serve_reads()
+                    return
+        self.client_req(request)
+
+    # The lease runs from the send time of the latest append_entries a
+    # majority (counting ourselves) has acked
+    def lease_valid(self):
+        now = self.node.now()
+        acked = sorted([now] + list(self.acked_at.values()), reverse=True)
+        quorum_acked = acked[self.majority(len(self.node.node_ids)) - 1]
+        return now < quorum_acked + self.election_timeout * self.lease_ratio
+
+    # Answers the lease reads whose read index has been applied
+    def serve_reads(self):
+        with self.lock:
+            if not self.pending_reads:
+                return
+            waiting = []
+            for read_index, request in self.pending_reads:
+                if self.state != State.Leader:
+                    error = self.node.generate_response('error', request['src'], RPCError.temporarily_unavailable("Not leader").to_json())
+                    self.node.reply(error, request)
+                elif read_index <= self.last_applied:
+                    _, response = self.state_machine.apply(request, self.node)
+                    self.node.reply(response, request)
+                else:
+                    waiting.append((read_index, request))
+            self.pending_reads = waiting
 
-    
     def client_req(self, request):
         with self.lock:
             if self.state != State.Leader:
                 if self.leader:
-                    body = request['body']
-                    self.node.log(f"Not leader, so proxying request to leader")
-                    self.node.reply(self.node.generate_response(body['type'], self.leader, body), request)
+                    self.node.debug('Not leader, so proxying request to leader', category='client')
+                    self.proxy(request, self.leader)
                 else:
                     raise RPCError.temporarily_unavailable("Not leader")
             else: 
-                self.log.append([{"term": self.term, "op": request}])
-                # self.state_machine, response = self.state_machine.apply(request, self.node)
-                # self.node.log(f"@sending_response {response}")
-                # self.node.reply(response, request)
+                self.pending_requests.append(request)
+                if self.batch_size <= len(self.pending_requests):
+                    self.flush_requests()
+                elif self.batch_flush is None:
+                    self.batch_flush = self.node.scheduler.call_later(self.batch_linger, self.flush_requests)
+
+    # Appends the pending client requests to the log as one batch and starts
+    # replicating them
+    def flush_requests(self):
+        with self.lock:
+            if self.batch_flush is not None:
+                self.batch_flush.cancel()
+                self.batch_flush = None
+            requests, self.pending_requests = self.pending_requests, []
+            if not requests:
+                return
+            if self.state != State.Leader:
+                for request in requests:
+                    error = self.node.generate_response('error', request['src'], RPCError.temporarily_unavailable("Not leader").to_json())
+                    self.node.reply(error, request)
+                return
+            self.log.append([{"term": self.term, "op": request} for request in requests])
+            self.node.debug('Appended a batch of %s client requests', len(requests), category='client')
+            self.replicate_log(True)
+            # our own copy only counts toward the commit index once synced
+            self.when_durable(self.advance_commit_index)
+
+    # Forwards a client request to the leader and relays its reply
+    def proxy(self, request, leader):
+        body = {k: v for k, v in request['body'].items() if k != 'msg_id'}
+
+        def relay(response):
+            reply_body = {k: v for k, v in response['body'].items() if k not in ('msg_id', 'in_reply_to')}
+            self.node.reply(self.node.generate_response(reply_body['type'], request['src'], reply_body), request)
+
+        # The leader may have applied the request before its reply got lost,
+        # so the outcome is unknown: answer with an indefinite error
+        def failed(error):
+            reply_body = RPCError.timeout(f"Leader {leader} did not answer").to_json()
+            self.node.reply(self.node.generate_response('error', request['src'], reply_body), request)
+
+        self.node.rpc(self.node.generate_response(body['type'], leader, body), relay).catch(failed)
 
 
     def leader_heart_beat(self):
-        time.sleep(random.random()/10)
         with self.lock:
             if self.election_deadline < self.node.now():
                 if self.state != State.Leader:
@@ -299,17 +779,20 @@ class Raft():
             else:
                 self.term = term
                 self.voted_for = None
+                self.save_hard_state()
 
     def become_candidate(self): 
         with self.lock:
             self.state = State.Candidate
             self.advance_term(self.term + 1)
             self.voted_for = self.node.node_id
+            self.save_hard_state()
             self.leader = None            
             self.reset_election_deadline()
             self.reset_stepdown_deadline()
             self.node.log(f"Became candidate for term {self.term}")
-            self.request_votes()
+            term = self.term
+            self.when_durable(lambda: self.request_votes() if self.state == State.Candidate and self.term == term else None)
 
     def become_leader(self):
         with self.lock:
@@ -317,12 +800,16 @@ class Raft():
                 raise Exception("Cannot become leader when not candidate")
             self.match_index = {}
             self.next_index = {}
+            self.inflight = {}
+            self.acked_at = {}
             self.last_replication = time.time() - time.time()
             self.leader = None
             for n in self.node.other_node_ids():
                 # we are taking + 1 because first entry in log is empty one
                 self.next_index[n] = self.log.size() + 1
                 self.match_index[n] = 0
+                self.inflight[n] = 0
+                self.acked_at[n] = 0
 
             self.state = State.Leader
             self.reset_stepdown_deadline()
@@ -333,9 +820,12 @@ class Raft():
             self.state = State.Follower
             self.match_index = None
             self.next_index = None
+            self.inflight = None
+            self.acked_at = None
             self.leader = None
             self.reset_election_deadline()
             self.node.log("Became follower")
+            self.serve_reads()
 
     def maybe_step_down(self, remote_term):
         with self.lock:
@@ -364,17 +854,24 @@ class Raft():
                 self.reset_stepdown_deadline()
                 with self.lock:
                     body = response['body']
-                    if self.state == State.Candidate:
-                        if self.term == term and self.term == body['term']:
-                            self.node.log(f"vote_granted vote for term {body}")
-                            if body['vote_granted']:
-                                votes.add(response['src'])
-                                self.node.log(f"Have votes: {votes}")
-                                if self.majority(len(self.node.node_ids)) <= len(votes):
-                                    self.node.log(f"Have majority: {votes}")
-                                    self.become_leader()
+                    self.maybe_step_down(body['term'])
+                    self.node.debug('vote_granted vote for term %s', body, category='election')
+
+            def granted(response):
+                body = response['body']
+                return body['vote_granted'] and body['term'] == term
 
-            self.node.brpc(body, callback)
+            # we only need votes from a majority; become leader as soon as
+            # they are in rather than waiting on slow or partitioned peers
+            def won(responses):
+                with self.lock:
+                    if self.state == State.Candidate and self.term == term:
+                        votes.update(response['src'] for response in responses)
+                        self.node.log(f"Have majority: {votes}")
+                        self.become_leader()
+
+            quorum = self.majority(len(self.node.node_ids)) - len(votes)
+            self.node.brpc(body, callback, quorum = quorum, predicate = granted, timeout = self.election_timeout).then(won)
 
 
     def majority(self, n):
@@ -390,29 +887,39 @@ class Raft():
             if self.state == State.Leader:
                 new_commit_index = self.mean(list(self.get_match_index().values()))
                 if new_commit_index > self.commit_index and self.term == self.log[new_commit_index]['term']:
-                    self.node.log(f"Advancing commit index to {new_commit_index}")
+                    self.node.debug('Advancing commit index to %s', new_commit_index, category='commit')
                     self.commit_index = new_commit_index
             self.advance_state_machine()
 
     def grant_vote(self, request):
         with self.lock:
             body = request['body']
+            if self.node.now() < self.leader_contact + self.election_timeout:
+                # Our leader may be serving lease reads; a candidate must
+                # not win with our vote before its lease runs out. This also
+                # holds for election_timeout after we start, since we may
+                # have acked a leader just before a restart.
+                self.node.debug('Heard from leader %s recently. Vote not granted.', self.leader, category='election')
+                response = self.node.generate_response('request_vote_res', request['src'], {"term": self.term, "vote_granted": False})
+                self.node.reply(response, request)
+                return
             self.maybe_step_down(body['term'])
             grant = False
             if body['term'] < self.term:
-                self.node.log(f"Received term {body['term']} is less than current term {self.term}. Vote not granted.")
+                self.node.debug('Received term %s is less than current term %s. Vote not granted.', body['term'], self.term, category='election')
             elif self.voted_for:
-                self.node.log(f"Already voted for {self.voted_for}. Vote not granted.")
+                self.node.debug('Already voted for %s. Vote not granted.', self.voted_for, category='election')
             elif body['last_log_term'] == self.log.last()['term'] and body['last_log_index'] < self.log.size():
-                self.log(f"Our logs are both at the term {self.log.last()['term']} but their log size is different so not granting votes")
+                self.node.debug('Our logs are both at the term %s but their log size is different so not granting votes', self.log.last()['term'], category='election')
             else:
-                self.node.log(f"Granting vote for term {body['term']}")
+                self.node.debug('Granting vote for term %s', body['term'], category='election')
                 grant = True
                 self.voted_for = body['candidate_id']
+                self.save_hard_state()
                 
 
             response = self.node.generate_response('request_vote_res', request['src'], {"term": self.term, "vote_granted": grant})
-            self.node.reply(response, request)
+            self.reply_durable(response, request)
 
     def reset_election_deadline(self):
         with self.lock:
@@ -0,0 +1,120 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+# A periodic or one-shot job owned by a Scheduler. Fixed-rate tasks keep to
+# a grid of start + n * interval and skip missed slots; fixed-delay tasks wait
+# interval after each run finishes. Either way up to `jitter` seconds of
+# random delay is added to every run.
+class Task():
+    FIXED_RATE = 'fixed_rate'
+    FIXED_DELAY = 'fixed_delay'
+
+    def __init__(self, fn, interval = None, mode = FIXED_RATE, jitter = 0):
+        self.fn = fn
+        self.interval = interval
+        self.mode = mode
+        self.jitter = jitter
+        self.base = None # next slot on the fixed-rate grid
+        self.cancelled = False
+        self.runs = 0
+        self.overruns = 0 # runs that took longer than interval
+        self.skipped = 0 # fixed-rate slots missed because of overruns
+        self.total_runtime = 0.0
+        self.max_runtime = 0.0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stats(self):
+        return {
+            'task': getattr(self.fn, '__qualname__', repr(self.fn)),
+            'interval': self.interval,
+            'mode': self.mode,
+            'runs': self.runs,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'avg_runtime': self.total_runtime / self.runs if self.runs else 0.0,
+            'max_runtime': self.max_runtime
+        }
+
+
+# Runs every task from one thread, ordered by a heap of due times.
+class Scheduler():
+    def __init__(self, on_error = None):
+        self.heap = [] # (due, sequence, task)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.tasks = []
+        self.on_error = on_error
+        threading.Thread(target=self.run, name='scheduler', daemon=True).start()
+
+    def add(self, task, delay = 0):
+        if task.interval is not None:
+            self.tasks.append(task)
+        task.base = time.monotonic() + delay
+        self.push(task, task.base + random.uniform(0, task.jitter))
+        return task
+
+    def every(self, fn, interval, mode = Task.FIXED_RATE, jitter = 0):
+        return self.add(Task(fn, interval, mode, jitter))
+
+    def call_later(self, delay, fn):
+        return self.add(Task(fn), delay)
+
+    def push(self, task, due):
+        with self.condition:
+            heapq.heappush(self.heap, (due, next(self.sequence), task))
+            if self.heap[0][2] is task:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                due, _, task = self.heap[0]
+                delay = due - time.monotonic()
+                if 0 < delay:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+
+            if task.cancelled:
+                continue
+
+            started = time.monotonic()
+            try:
+                task.fn()
+            except BaseException as e:
+                if self.on_error:
+                    self.on_error(task, e)
+            finished = time.monotonic()
+            self.record(task, finished - started)
+
+            if task.interval is not None and not task.cancelled:
+                self.reschedule(task, finished)
+
+    def record(self, task, runtime):
+        task.runs += 1
+        task.total_runtime += runtime
+        task.max_runtime = max(task.max_runtime, runtime)
+        if task.interval is not None and task.interval < runtime:
+            task.overruns += 1
+
+    def reschedule(self, task, finished):
+        if task.mode == Task.FIXED_DELAY:
+            task.base = finished + task.interval
+        else:
+            task.base += task.interval
+            if task.base < finished:
+                missed = int((finished - task.base) / task.interval) + 1
+                task.skipped += missed
+                task.base += missed * task.interval
+        self.push(task, task.base + random.uniform(0, task.jitter))
+
+    def stats(self):
+        return [task.stats() for task in self.tasks if not task.cancelled]
@@ -0,0 +1,202 @@
+import mmap
+import os
+import struct
+import zlib
+
+
+class Segment():
+    def __init__(self, first, path, size = 0):
+        self.first = first # index of the first record
+        self.path = path
+        self.size = size
+
+
+# Raft log entries in append-only segment files under one directory. Every
+# record is a header (payload length, crc32, term) followed by the entry as
+# the node's codec encoded it, so entries are serialized once. Segments are
+# named after the index of their first record and a new one starts once the
+# last reaches segment_bytes. An in-memory index maps each log index to its
+# segment and offset, so truncating never scans the files. Entries are only
+# read back, through a memory map, on recovery; Log serves reads from
+# memory.
+#
+# Writes reach the page cache right away, which survives the process being
+# killed; sync() makes them durable across machine crashes. With fsync set,
+# every append syncs before returning.
+#
+# Not thread-safe; the Raft lock covers it.
+class SegmentLog():
+    HEADER = struct.Struct('>IIQ')
+    TERM = struct.Struct('>Q')
+    SUFFIX = '.seg'
+    SNAPSHOT = 'snapshot'
+
+    def __init__(self, directory, codec, segment_bytes = 4 * 1024 * 1024, fsync = True):
+        self.directory = directory
+        self.codec = codec
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.segments = []
+        self.first_index = 1
+        self.locations = [] # (segment, offset) of every index from first_index on
+        self.fd = None # the last segment, open for appending
+        self.dirty = False
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def last_index(self):
+        return self.first_index + len(self.locations) - 1
+
+    # Loads every intact record, in index order, and returns the entries and
+    # their encoded sizes. A torn or corrupt record ends the log: it and
+    # everything after it is cut off.
+    def recover(self):
+        entries = []
+        sizes = []
+        paths = sorted(p for p in os.listdir(self.directory) if p.endswith(SegmentLog.SUFFIX))
+        for i, name in enumerate(paths):
+            segment = Segment(int(name[:-len(SegmentLog.SUFFIX)]), os.path.join(self.directory, name))
+            if self.segments and segment.first != self.last_index() + 1:
+                self.remove(paths[i:])
+                break
+            if not self.segments:
+                self.first_index = segment.first
+            self.segments.append(segment)
+            segment.size = self.scan(segment, entries, sizes)
+            if segment.size < os.path.getsize(segment.path):
+                os.truncate(segment.path, segment.size)
+                self.remove(paths[i + 1:])
+                break
+
+        if self.segments:
+            self.fd = os.open(self.segments[-1].path, os.O_WRONLY | os.O_APPEND)
+        return entries, sizes
+
+    # Reads a segment's records into entries, returning where they end
+    def scan(self, segment, entries, sizes):
+        size = os.path.getsize(segment.path)
+        if not size:
+            return 0
+        offset = 0
+        with open(segment.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while offset + SegmentLog.HEADER.size <= size:
+                length, crc, term = SegmentLog.HEADER.unpack_from(mm, offset)
+                start = offset + SegmentLog.HEADER.size
+                if size < start + length:
+                    break
+                payload = mm[start:start + length]
+                if crc != zlib.crc32(payload, zlib.crc32(SegmentLog.TERM.pack(term))):
+                    break
+                entries.append(self.codec.decode(payload))
+                sizes.append(length)
+                self.locations.append((segment, offset))
+                offset = start + length
+        return offset
+
+    def remove(self, names):
+        for name in names:
+            os.remove(os.path.join(self.directory, name))
+
+    # Appends entries after the last index; encoded holds their codec
+    # encoding
+    def append(self, entries, encoded):
+        chunks = []
+        for entry, payload in zip(entries, encoded):
+            if self.fd is None or self.segment_bytes <= self.segments[-1].size:
+                self.write(chunks)
+                self.roll(self.last_index() + 1)
+            term = entry['term']
+            segment = self.segments[-1]
+            self.locations.append((segment, segment.size))
+            chunks.append(SegmentLog.HEADER.pack(len(payload), zlib.crc32(payload, zlib.crc32(SegmentLog.TERM.pack(term))), term))
+            chunks.append(payload)
+            segment.size += SegmentLog.HEADER.size + len(payload)
+        self.write(chunks)
+        if self.fsync:
+            self.sync()
+
+    def write(self, chunks):
+        if chunks:
+            os.write(self.fd, b''.join(chunks))
+            chunks.clear()
+            self.dirty = True
+
+    # Starts a new segment whose first record will be index
+    def roll(self, index):
+        self.sync()
+        if self.fd is not None:
+            os.close(self.fd)
+        segment = Segment(index, os.path.join(self.directory, f'{index:020d}{SegmentLog.SUFFIX}'))
+        self.fd = os.open(segment.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.segments.append(segment)
+        self.sync_directory()
+
+    # Deletes every record after index
+    def truncate(self, index):
+        if self.last_index() <= index:
+            return
+        position = max(0, index + 1 - self.first_index)
+        segment, offset = self.locations[position]
+        while self.segments[-1] is not segment:
+            os.remove(self.segments.pop().path)
+        os.close(self.fd)
+        os.truncate(segment.path, offset)
+        segment.size = offset
+        self.fd = os.open(segment.path, os.O_WRONLY | os.O_APPEND)
+        del self.locations[position:]
+        self.dirty = True
+        if self.fsync:
+            self.sync()
+
+    # Deletes the segments that only hold records before index
+    def compact(self, index):
+        while 1 < len(self.segments) and self.segments[1].first <= index:
+            os.remove(self.segments.pop(0).path)
+        if self.segments and self.first_index < self.segments[0].first:
+            del self.locations[:self.segments[0].first - self.first_index]
+            self.first_index = self.segments[0].first
+
+    # Replaces the whole log with entry at index
+    def reset(self, index, entry):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        for segment in self.segments:
+            os.remove(segment.path)
+        self.segments = []
+        self.locations = []
+        self.first_index = index
+        self.dirty = False
+        self.append([entry], [self.codec.encode(entry)])
+
+    def sync(self):
+        if self.dirty:
+            os.fsync(self.fd)
+            self.dirty = False
+
+    def sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # Snapshots are written whole, next to the segments, and replaced
+    # atomically
+    def save_snapshot(self, snapshot):
+        path = os.path.join(self.directory, SegmentLog.SNAPSHOT)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self.codec.encode(snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.sync_directory()
+
+    def load_snapshot(self):
+        path = os.path.join(self.directory, SegmentLog.SNAPSHOT)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return self.codec.decode(f.read())
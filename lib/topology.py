@@ -0,0 +1,61 @@
+import math
+
+# Broadcast overlays. Each function maps every node id to the neighbors it
+# gossips with; edges are symmetric so a message reaches every node whichever
+# node it starts from.
+
+def _add_edge(graph, a, b):
+    graph[a].append(b)
+    graph[b].append(a)
+
+
+# Two-level tree over node_ids: the first node is the root, about sqrt(n)
+# nodes hang off it and the rest hang off those, so no two nodes are more
+# than four hops apart. Maelstrom's provided grid has a larger diameter
+# (8 on 5x5), and so does any spanning tree of it, so the provided edges
+# are left to repair.
+def spanning_tree(node_ids):
+    return kary_tree(node_ids, max(1, math.ceil(math.sqrt(len(node_ids) - 1))))
+
+
+# Balanced tree where every node has up to k children, in node_ids order
+def kary_tree(node_ids, k = 4):
+    graph = {n: [] for n in node_ids}
+    for i in range(1, len(node_ids)):
+        _add_edge(graph, node_ids[(i - 1) // k], node_ids[i])
+    return graph
+
+
+# Star around the first node. The second node is the fallback hub; its
+# edges are returned separately for repair only.
+def hub(node_ids):
+    graph = {n: [] for n in node_ids}
+    fallback = {n: [] for n in node_ids}
+    for n in node_ids[1:]:
+        _add_edge(graph, node_ids[0], n)
+    if 1 < len(node_ids):
+        for n in node_ids[2:]:
+            _add_edge(fallback, node_ids[1], n)
+    return graph, fallback
+
+
+# Returns (neighbors, repair_neighbors) for node_id. Repair neighbors are
+# the edges of the provided topology (and the fallback hub) that are not
+# already part of the overlay.
+def overlay(name, node_id, node_ids, topology, k = 4):
+    fallback = None
+    if name == 'tree':
+        graph = spanning_tree(node_ids)
+    elif name == 'kary':
+        graph = kary_tree(node_ids, k)
+    elif name == 'hub':
+        graph, fallback = hub(node_ids)
+    else:
+        raise ValueError(f'Unknown overlay {name}')
+
+    neighbors = graph[node_id]
+    repair = list(topology.get(node_id, [])) if topology else []
+    if fallback:
+        repair.extend(fallback[node_id])
+    repair = [n for n in dict.fromkeys(repair) if n not in neighbors and n != node_id]
+    return neighbors, repair
@@ -0,0 +1,57 @@
+import queue
+import sys
+import threading
+
+
+# Owns stdout and stderr. Callers enqueue already formatted text (bytes for
+# stdout, str for stderr) and return immediately; a single thread drains
+# whatever is queued and writes it with one write and one flush per stream.
+class Writer():
+    def __init__(self, out = None, err = None):
+        self.out = out or sys.stdout.buffer
+        self.err = err or sys.stderr
+        self.queue = queue.SimpleQueue()
+        self.idle = threading.Condition()
+        self.pending = 0
+        self.thread = threading.Thread(target=self.run, name='writer', daemon=True)
+        self.thread.start()
+
+    def write_out(self, text):
+        self.write(self.out, text)
+
+    def write_err(self, text):
+        self.write(self.err, text)
+
+    # Queues text for any writable stream, e.g. a structured log file
+    def write(self, stream, text):
+        with self.idle:
+            self.pending += 1
+        self.queue.put((stream, text))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            chunks = dict()
+            for stream, text in batch:
+                chunks.setdefault(stream, []).append(text)
+            for stream, texts in chunks.items():
+                empty = b'' if isinstance(texts[0], bytes) else ''
+                stream.write(empty.join(texts))
+                stream.flush()
+
+            with self.idle:
+                self.pending -= len(batch)
+                if self.pending == 0:
+                    self.idle.notify_all()
+
+    # Blocks until everything queued so far has been written
+    def drain(self):
+        with self.idle:
+            while self.pending:
+                self.idle.wait()